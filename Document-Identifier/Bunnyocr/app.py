@@ -1,9 +1,17 @@
+import os
+import sys
 import streamlit as st
 from PIL import Image
 from io import BytesIO
 from helpers.llm_helper import analyze_image_file, stream_parser
 from config import Config
 
+# shared metrics layer lives next to the CRAFT code
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Craft-Model', 'Craft'))
+import metrics
+
+metrics.configure(trace_file=Config.TRACE_FILE)
+
 # Configuring the page settings
 st.set_page_config(page_title="OCR", 
                    page_icon="📸",
@@ -35,11 +43,15 @@ if captured_image is not None:
         with st.status(":red[Processing image file. DON'T LEAVE THIS PAGE WHILE IMAGE FILE IS BEING ANALYZED...]", expanded=True) as status:
             st.write(":orange[Analyzing Image File...]")
 
-            # Analyze the image using the selected model
-            stream = analyze_image_file(image_bytes, model=image_model, user_prompt="OCR and extract the handwritten text from this image.")
-            
-            # Stream output from the analysis
-            stream_output = st.write_stream(stream_parser(stream))
+            with metrics.trace(captured_image.name, model=image_model), metrics.timed('llm'):
+                # Analyze the image using the selected model
+                stream = analyze_image_file(image_bytes, model=image_model, user_prompt="OCR and extract the handwritten text from this image.")
+
+                # Stream output from the analysis
+                stream_output = st.write_stream(stream_parser(stream))
+                metrics.inc('pages')
+            if Config.METRICS_FILE:
+                metrics.write_prometheus(Config.METRICS_FILE)
 
             st.write(":green[Done analyzing image file]")
 else:
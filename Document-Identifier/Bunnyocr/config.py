@@ -1,6 +1,12 @@
+import os
+
 class Config:
     PAGE_TITLE = "Image Analyzer"
 
+    # Prometheus text file rewritten after every request, and a JSONL trace with one line per image (unset: off)
+    METRICS_FILE = os.environ.get('OCR_METRICS_FILE')
+    TRACE_FILE = os.environ.get('OCR_TRACE_FILE')
+
     OLLAMA_MODELS = ('Bunny-Llama-3-8B-V-int4','llava:7b-v1.6', 'bakllava','minicpm-v')
 
     # You can access OLLAMA_MODELS after the class is fully defined
@@ -0,0 +1,243 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+
+import cv2
+import numpy as np
+import torch
+
+import craft_utils
+import imgproc
+import file_utils
+
+STAGES = ['loadImage', 'resize_aspect_ratio', 'normalizeMeanVariance', 'forward', 'getDetBoxes_core', 'getPoly_core',
+          'adjustResultCoordinates', 'saveResult', 'trocr']
+
+_WORDS = ['GOVERNMENT', 'OF', 'INDIA', 'INCOME', 'TAX', 'DEPARTMENT', 'NAME', 'FATHER', 'DOB', 'MALE', 'FEMALE',
+          'ADDRESS', 'PERMANENT', 'ACCOUNT', 'NUMBER', 'SIGNATURE', 'ISSUE', 'DATE', 'VALID', 'UNTIL']
+
+def make_document(num_words=24, text_height=24, long_side=1011, aspect_ratio=1.586, seed=0):
+    """ synthetic ID-card-like image: light textured background, rows of printed words and digit groups
+    Args:
+        num_words (int): number of words drawn
+        text_height (int): approximate cap height of the text in pixels
+        long_side (int): width of the card, ID-1 cards are 1.586 times wider than tall
+    Return:
+        RGB uint8 image
+    """
+    rng = np.random.RandomState(seed)
+    w, h = int(long_side), int(long_side / aspect_ratio)
+    img = np.full((h, w, 3), 235, dtype=np.uint8)
+    img = np.clip(img + rng.normal(0, 6, img.shape), 0, 255).astype(np.uint8)
+    cv2.rectangle(img, (0, 0), (w - 1, max(h // 8, 1)), (180, 120, 60), -1)      # header band
+
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    scale = text_height / 22.0
+    thickness = max(1, int(round(text_height / 12)))
+    x, y = text_height, h // 8 + 2 * text_height
+    for i in range(num_words):
+        if rng.rand() < 0.3:
+            word = ' '.join(str(rng.randint(1000, 9999)) for _ in range(rng.randint(1, 4)))
+        else:
+            word = _WORDS[rng.randint(len(_WORDS))]
+        (tw, th), _ = cv2.getTextSize(word, font, scale, thickness)
+        if x + tw > w - text_height:
+            x, y = text_height, y + 2 * text_height
+        if y > h - text_height:
+            break
+        cv2.putText(img, word, (x, y), font, scale, (20, 20, 20), thickness, cv2.LINE_AA)
+        x += tw + text_height
+    return img
+
+def synthetic_documents(folder, num_images=8, num_words=24, text_height=24, long_side=1011, seed=0):
+    # written as JPEG so loadImage is timed on a real decode
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for i in range(num_images):
+        path = os.path.join(folder, 'synthetic_{:03d}.jpg'.format(i))
+        cv2.imwrite(path, make_document(num_words, text_height, long_side, seed=seed + i)[:, :, ::-1])
+        paths.append(path)
+    return paths
+
+def summarize(samples):
+    # seconds in, milliseconds out
+    if not samples:
+        return None
+    ms = np.array(samples) * 1000
+    return {
+        'n': len(ms),
+        'mean_ms': float(ms.mean()),
+        'min_ms': float(ms.min()),
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p90_ms': float(np.percentile(ms, 90)),
+        'p99_ms': float(np.percentile(ms, 99)),
+        'max_ms': float(ms.max()),
+    }
+
+class StageTimer:
+    """ collects per-stage durations; recording is switched off during warm-up """
+    def __init__(self, cuda=False):
+        self.cuda = cuda
+        self.recording = False
+        self.samples = {}
+
+    def run(self, name, fn, *args, **kwargs):
+        t = time.perf_counter()
+        out = fn(*args, **kwargs)
+        if self.cuda:
+            torch.cuda.synchronize()
+        if self.recording:
+            self.samples.setdefault(name, []).append(time.perf_counter() - t)
+        return out
+
+def _forward(net, refine_net, x, cuda):
+    x = torch.from_numpy(x).permute(2, 0, 1).unsqueeze(0)
+    if cuda:
+        x = x.cuda()
+    with torch.no_grad():
+        y, feature = net(x)
+        score_text = y[0, :, :, 0].cpu().data.numpy()
+        if refine_net is not None:
+            score_link = refine_net(y, feature)[0, :, :, 0].cpu().data.numpy()
+        else:
+            score_link = y[0, :, :, 1].cpu().data.numpy()
+    return score_text, score_link
+
+def run_document(timer, image_path, net, refine_net, cuda, canvas_size, mag_ratio, poly, text_threshold, link_threshold, low_text,
+                 result_folder, ocr=False):
+    # the stages of test.py / craft_module.process_image, one timer entry each
+    image = timer.run('loadImage', imgproc.loadImage, image_path)
+    img_resized, target_ratio, _ = timer.run('resize_aspect_ratio', imgproc.resize_aspect_ratio, image, canvas_size,
+                                             interpolation=cv2.INTER_LINEAR, mag_ratio=mag_ratio)
+    ratio = 1 / target_ratio
+    x = timer.run('normalizeMeanVariance', imgproc.normalizeMeanVariance, img_resized)
+    score_text, score_link = timer.run('forward', _forward, net, refine_net, x, cuda)
+    boxes, labels, mapper = timer.run('getDetBoxes_core', craft_utils.getDetBoxes_core, score_text, score_link,
+                                      text_threshold, link_threshold, low_text)
+    if poly:
+        polys = timer.run('getPoly_core', craft_utils.getPoly_core, boxes, labels, mapper, score_link)
+    else:
+        polys = [None] * len(boxes)
+
+    def adjust(boxes, polys):
+        boxes = craft_utils.adjustResultCoordinates(boxes, ratio, ratio)
+        polys = craft_utils.adjustResultCoordinates(polys, ratio, ratio)
+        for k in range(len(polys)):
+            if polys[k] is None:
+                polys[k] = boxes[k]
+        return boxes, polys
+    boxes, polys = timer.run('adjustResultCoordinates', adjust, boxes, polys)
+    timer.run('saveResult', file_utils.saveResult, image_path, image[:, :, ::-1], polys, dirname=result_folder)
+
+    if ocr and len(polys):
+        import trocr
+        from craft_module import crop_segments
+        crops = [crop for crop, box in crop_segments(image, polys)]
+        timer.run('trocr', trocr.ocr_printed_images, crops)
+    return len(polys)
+
+def run_benchmark(image_paths, net, refine_net=None, cuda=False, canvas_size=1280, mag_ratio=1.5, poly=False,
+                  text_threshold=0.7, link_threshold=0.4, low_text=0.4, warmup=2, repeat=10, ocr=False, result_folder=None):
+    """ time every stage of the detection path over image_paths
+    Args:
+        warmup (int): passes over all images before timing starts
+        repeat (int): timed passes over all images
+        result_folder (str): where saveResult writes, a temporary folder by default
+    Return:
+        dict of stage name -> summarize() output, plus 'document' for the whole path and 'boxes' per image
+    """
+    tmp = None
+    if result_folder is None:
+        tmp = result_folder = tempfile.mkdtemp(prefix='craft_bench_') + '/'
+    timer = StageTimer(cuda)
+    docs = []
+    boxes = {}
+    try:
+        for rep in range(warmup + repeat):
+            timer.recording = rep >= warmup
+            for path in image_paths:
+                t = time.perf_counter()
+                boxes[path] = run_document(timer, path, net, refine_net, cuda, canvas_size, mag_ratio, poly or refine_net is not None,
+                                           text_threshold, link_threshold, low_text, result_folder, ocr)
+                if timer.recording:
+                    docs.append(time.perf_counter() - t)
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    stages = {name: summarize(timer.samples[name]) for name in STAGES if name in timer.samples}
+    stages['document'] = summarize(docs)
+    return {'stages': stages, 'boxes': boxes}
+
+def environment(cuda):
+    env = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'torch': torch.__version__,
+        'opencv': cv2.__version__,
+        'torch_threads': torch.get_num_threads(),
+        'cpu_count': os.cpu_count(),
+    }
+    if cuda:
+        env['gpu'] = torch.cuda.get_device_name(0)
+    return env
+
+def print_table(stages):
+    print("{:<26s}{:>8s}{:>10s}{:>10s}{:>10s}{:>10s}".format('stage', 'n', 'mean ms', 'p50 ms', 'p90 ms', 'p99 ms'))
+    for name, s in stages.items():
+        print("{:<26s}{:>8d}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}".format(name, s['n'], s['mean_ms'], s['p50_ms'], s['p90_ms'], s['p99_ms']))
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Stage-level benchmark of the CRAFT detection path')
+    parser.add_argument('--trained_model', default='weights/craft_mlt_25k.pth', type=str, help='pretrained model')
+    parser.add_argument('--refiner_model', default=None, type=str, help='pretrained refiner model (enables link refiner)')
+    parser.add_argument('--backend', default='torch', choices=['torch', 'onnx'], help='inference engine for the detector')
+    parser.add_argument('--cuda', default=False, action='store_true', help='use cuda for inference')
+    parser.add_argument('--image_folder', default=None, type=str, help='benchmark these images (e.g. ../../images) instead of synthetic ones')
+    parser.add_argument('--num_images', default=8, type=int, help='number of synthetic documents')
+    parser.add_argument('--num_words', default=24, type=int, help='words per synthetic document')
+    parser.add_argument('--text_size', default=24, type=int, help='text height of synthetic documents in pixels')
+    parser.add_argument('--resolution', default=1011, type=int, help='long side of synthetic documents in pixels')
+    parser.add_argument('--seed', default=0, type=int, help='seed of the synthetic documents')
+    parser.add_argument('--canvas_size', default=1280, type=int, help='image size for inference')
+    parser.add_argument('--mag_ratio', default=1.5, type=float, help='image magnification ratio')
+    parser.add_argument('--poly', default=False, action='store_true', help='enable polygon type (times getPoly_core)')
+    parser.add_argument('--ocr', default=False, action='store_true', help='also time TrOCR on the detected crops')
+    parser.add_argument('--warmup', default=2, type=int, help='untimed passes over all images')
+    parser.add_argument('--repeat', default=10, type=int, help='timed passes over all images')
+    parser.add_argument('--output', default=None, type=str, help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    from craft_module import load_model, load_refiner
+    net = load_model(args.trained_model, args.cuda, args.backend)
+    refine_net = load_refiner(args.refiner_model, args.cuda, args.backend) if args.refiner_model else None
+
+    tmp = None
+    if args.image_folder:
+        image_paths, _, _ = file_utils.get_files(args.image_folder)
+    else:
+        tmp = tempfile.mkdtemp(prefix='craft_docs_')
+        image_paths = synthetic_documents(tmp, args.num_images, args.num_words, args.text_size, args.resolution, args.seed)
+    if not image_paths:
+        sys.exit("no images to benchmark")
+
+    try:
+        result = run_benchmark(image_paths, net, refine_net, args.cuda, args.canvas_size, args.mag_ratio, args.poly,
+                               warmup=args.warmup, repeat=args.repeat, ocr=args.ocr)
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    print_table(result['stages'])
+    if args.output:
+        config = {k: v for k, v in vars(args).items() if k != 'output'}
+        if tmp is not None:
+            result['boxes'] = {os.path.basename(path): n for path, n in result['boxes'].items()}
+        with open(args.output, 'w') as f:
+            json.dump({'config': config, 'environment': environment(args.cuda), **result}, f, indent=4)
+        print("Saved " + args.output)
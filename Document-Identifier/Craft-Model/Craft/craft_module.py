@@ -1,5 +1,6 @@
 import os
 import time
+import threading
 import torch
 from torch.autograd import Variable
 import cv2
@@ -11,6 +12,8 @@ import gdown
 import craft_utils
 import imgproc
 import file_utils
+import metrics
+import onnx_backend
 from craft import CRAFT
 
 weights = {
@@ -40,61 +43,237 @@ def copyStateDict(state_dict):
         new_state_dict[name] = v
     return new_state_dict
 
-def load_model(trained_model, cuda):
+def _load_checkpoint(path, cuda, arch):
+    checkpoint = torch.load(path, map_location='cpu')
+    if isinstance(checkpoint, dict) and checkpoint.get('quantized') is True:
+        import quantize     # torch.ao is only needed for INT8 checkpoints
+        if cuda:
+            raise ValueError(f"{path} is an INT8 checkpoint, which only runs on CPU (cuda=False)")
+        return quantize.load_quantized(checkpoint, arch)
+    return copyStateDict(checkpoint)
+
+def load_model(trained_model, cuda, backend='torch', num_threads=0):
+    # num_threads: onnxruntime intra-op threads (0: all cores); torch threads are set process-wide
+    if backend == 'onnx':
+        return onnx_backend.load_onnx(trained_model, cuda, 'craft', load_model, num_threads)
+    checkpoint = _load_checkpoint(trained_model, cuda, 'craft')
+    if isinstance(checkpoint, torch.nn.Module):
+        return checkpoint
     net = CRAFT()  # initialize
+    net.load_state_dict(checkpoint)
     if cuda:
-        net.load_state_dict(copyStateDict(torch.load(trained_model)))
         net = net.cuda()
         net = torch.nn.DataParallel(net)
         torch.backends.cudnn.benchmark = False
-    else:
-        net.load_state_dict(copyStateDict(torch.load(trained_model, map_location='cpu')))
     net.eval()
     return net
 
-def process_image(net, image, text_threshold, link_threshold, low_text, cuda, poly, refine_net=None):
-    # resize
-    img_resized, target_ratio, size_heatmap = imgproc.resize_aspect_ratio(image, 1280, interpolation=cv2.INTER_LINEAR, mag_ratio=1.5)
-    ratio_h = ratio_w = 1 / target_ratio
-
-    # preprocessing
-    x = imgproc.normalizeMeanVariance(img_resized)
-    x = torch.from_numpy(x).permute(2, 0, 1)  # [h, w, c] to [c, h, w]
-    x = Variable(x.unsqueeze(0))  # [c, h, w] to [b, c, h, w]
+def load_refiner(refiner_model, cuda, backend='torch', num_threads=0):
+    from refinenet import RefineNet
+    if backend == 'onnx':
+        return onnx_backend.load_onnx(refiner_model, cuda, 'refinenet', load_refiner, num_threads)
+    checkpoint = _load_checkpoint(refiner_model, cuda, 'refinenet')
+    if isinstance(checkpoint, torch.nn.Module):
+        return checkpoint
+    refine_net = RefineNet()
+    refine_net.load_state_dict(checkpoint)
     if cuda:
-        x = x.cuda()
+        refine_net = refine_net.cuda()
+        refine_net = torch.nn.DataParallel(refine_net)
+    refine_net.eval()
+    return refine_net
+
+# process-wide model registry: (weight path, device, refiner path, backend) -> (net, refine_net)
+_models = {}
+_models_lock = threading.Lock()
+
+def _model_key(trained_model, cuda, refiner_model, backend='torch'):
+    return (os.path.abspath(trained_model), 'cuda' if cuda else 'cpu',
+            os.path.abspath(refiner_model) if refiner_model else None, backend)
+
+def get_models(trained_model='weights/craft_mlt_25k.pth', cuda=True, refiner_model=None, backend='torch'):
+    key = _model_key(trained_model, cuda, refiner_model, backend)
+    with _models_lock:
+        if key not in _models:
+            net = load_model(trained_model, cuda, backend)
+            refine_net = load_refiner(refiner_model, cuda, backend) if refiner_model else None
+            _models[key] = (net, refine_net)
+        return _models[key]
+
+def warmup_models(trained_model='weights/craft_mlt_25k.pth', cuda=True, refiner_model=None, canvas_size=1280, backend='torch'):
+    net, refine_net = get_models(trained_model, cuda, refiner_model, backend)
+    # one dummy forward so lazy allocations happen before the first real request
+    dummy = np.zeros((canvas_size, canvas_size, 3), dtype=np.uint8)
+    process_image(net, dummy, 0.7, 0.4, 0.4, cuda, False, refine_net)
+    return net, refine_net
+
+def unload_models(trained_model=None, cuda=None, refiner_model=None, backend='torch'):
+    with _models_lock:
+        if trained_model is None:
+            _models.clear()
+        else:
+            _models.pop(_model_key(trained_model, cuda, refiner_model, backend), None)
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+def process_image(net, image, text_threshold, link_threshold, low_text, cuda, poly, refine_net=None, render=False):
+    return process_images(net, [image], text_threshold, link_threshold, low_text, cuda, poly, refine_net, render=render)[0]
+
+def forward_images(net, images, cuda, refine_net=None, canvas_size=1280, mag_ratio=1.5, batch_size=8):
+    # yields (index, score_text, score_link, ratio) per image, one forward pass per canvas-shape bucket
+    # resize, grouping images by the padded canvas shape so each group stacks into one tensor
+    buckets = OrderedDict()
+    for idx, image in enumerate(images):
+        with metrics.timed('preprocess'):
+            img_resized, target_ratio, size_heatmap = imgproc.resize_aspect_ratio(image, canvas_size, interpolation=cv2.INTER_LINEAR, mag_ratio=mag_ratio)
+        buckets.setdefault(img_resized.shape[:2], []).append((idx, img_resized, 1 / target_ratio))
+
+    for entries in buckets.values():
+        for b in range(0, len(entries), batch_size):
+            chunk = entries[b:b + batch_size]
+
+            # preprocessing
+            with metrics.timed('preprocess'):
+                x = np.stack([imgproc.normalizeMeanVariance(img_resized) for _, img_resized, _ in chunk])
+                x = torch.from_numpy(x).permute(0, 3, 1, 2)  # [b, h, w, c] to [b, c, h, w]
+                if cuda:
+                    x = x.cuda()
+
+            # forward pass, up to the score maps being back on the host
+            with metrics.timed('forward'), torch.no_grad():
+                y, feature = net(x)
+                y_refiner = refine_net(y, feature) if refine_net is not None else None
+
+                # make score and link map
+                score_texts = y[:, :, :, 0].cpu().data.numpy()
+                if y_refiner is not None:
+                    score_links = y_refiner[:, :, :, 0].cpu().data.numpy()
+                else:
+                    score_links = y[:, :, :, 1].cpu().data.numpy()
+
+            for i, (idx, _, ratio) in enumerate(chunk):
+                yield idx, score_texts[i], score_links[i], ratio
+
+def process_images(net, images, text_threshold, link_threshold, low_text, cuda, poly, refine_net=None,
+                   canvas_size=1280, mag_ratio=1.5, batch_size=8, render=False):
+    results = [None] * len(images)
+    for idx, score_text, score_link, ratio in forward_images(net, images, cuda, refine_net, canvas_size, mag_ratio, batch_size):
+        results[idx] = postprocess(score_text, score_link, ratio, ratio, text_threshold, link_threshold, low_text, poly, render)
+    return results
+
+def estimate_char_height(score_text, low_text):
+    # median height of the character blobs in a region score map, None when nothing passes low_text
+    ret, text_score = cv2.threshold(score_text, low_text, 1, 0)
+    nLabels, labels, stats, centroids = cv2.connectedComponentsWithStats(text_score.astype(np.uint8), connectivity=4)
+    heights = stats[1:, cv2.CC_STAT_HEIGHT][stats[1:, cv2.CC_STAT_AREA] >= 2]
+    if len(heights) == 0:
+        return None
+    return float(np.median(heights))
 
-    # forward pass
-    with torch.no_grad():
-        y, feature = net(x)
+def process_image_adaptive(net, image, text_threshold, link_threshold, low_text, cuda, poly, refine_net=None,
+                           probe_size=512, min_char_height=16, canvas_size=1280, render=False):
+    # cheap low resolution probe first, then the smallest canvas that keeps characters min_char_height pixels tall
+    img_h, img_w = image.shape[:2]
+    _, score_text, score_link, ratio = next(forward_images(net, [image], cuda, None, canvas_size=probe_size, mag_ratio=1))
+    char_h = estimate_char_height(score_text, low_text)
+    if char_h is None:
+        return [], [], None
 
-    # make score and link map
-    score_text = y[0, :, :, 0].cpu().data.numpy()
-    score_link = y[0, :, :, 1].cpu().data.numpy()
+    # score maps are at half the canvas resolution, ratio maps canvas pixels back to the image
+    char_h = char_h * 2 * ratio
+    target_size = int(min(max(max(img_h, img_w) * min_char_height / char_h, 32), canvas_size))
+    if target_size * ratio <= max(img_h, img_w) and refine_net is None:
+        # the probe was already fine enough
+        return postprocess(score_text, score_link, ratio, ratio, text_threshold, link_threshold, low_text, poly, render)
 
-    # refine link
-    if refine_net is not None:
-        with torch.no_grad():
-            y_refiner = refine_net(y, feature)
-        score_link = y_refiner[0, :, :, 0].cpu().data.numpy()
+    return process_images(net, [image], text_threshold, link_threshold, low_text, cuda, poly, refine_net,
+                          canvas_size=target_size, mag_ratio=target_size / max(img_h, img_w), render=render)[0]
 
-    # Post-processing
-    boxes, polys = craft_utils.getDetBoxes(score_text, score_link, text_threshold, link_threshold, low_text, poly)
+def postprocess(score_text, score_link, ratio_w, ratio_h, text_threshold, link_threshold, low_text, poly, render=False):
+    with metrics.timed('postprocess'):
+        # Post-processing
+        boxes, polys = craft_utils.getDetBoxes(score_text, score_link, text_threshold, link_threshold, low_text, poly)
 
-    # coordinate adjustment
-    boxes = craft_utils.adjustResultCoordinates(boxes, ratio_w, ratio_h)
-    polys = craft_utils.adjustResultCoordinates(polys, ratio_w, ratio_h)
-    for k in range(len(polys)):
-        if polys[k] is None:
-            polys[k] = boxes[k]
+        # coordinate adjustment
+        boxes = craft_utils.adjustResultCoordinates(boxes, ratio_w, ratio_h)
+        polys = craft_utils.adjustResultCoordinates(polys, ratio_w, ratio_h)
+        for k in range(len(polys)):
+            if polys[k] is None:
+                polys[k] = boxes[k]
 
-    # render results (optional)
-    render_img = score_text.copy()
-    render_img = np.hstack((render_img, score_link))
-    ret_score_text = imgproc.cvt2HeatmapImg(render_img)
+    # render results (debug output only)
+    ret_score_text = None
+    if render:
+        ret_score_text = imgproc.cvt2HeatmapImg(np.hstack((score_text, score_link)))
 
     return boxes, polys, ret_score_text
 
+def _tile_origins(length, tile_size, overlap):
+    if length <= tile_size:
+        return [0]
+    origins = list(range(0, length - tile_size, tile_size - overlap))
+    return origins + [length - tile_size]
+
+def process_image_tiled(net, image, text_threshold, link_threshold, low_text, cuda, poly, refine_net=None,
+                        tile_size=1280, overlap=256, batch_size=4):
+    # detect at native scale on overlapping tiles; only batch_size tiles are resident at once
+    img_h, img_w = image.shape[:2]
+    tiles = [(x0, y0) for y0 in _tile_origins(img_h, tile_size, overlap) for x0 in _tile_origins(img_w, tile_size, overlap)]
+
+    dets = []   # (box, poly, tile index, touches an inner seam)
+    for b in range(0, len(tiles), batch_size):
+        chunk = tiles[b:b + batch_size]
+        crops = [image[y0:y0 + tile_size, x0:x0 + tile_size] for x0, y0 in chunk]
+        results = process_images(net, crops, text_threshold, link_threshold, low_text, cuda, poly, refine_net,
+                                  canvas_size=tile_size, mag_ratio=1, batch_size=batch_size)
+        for t, ((x0, y0), crop, (boxes, polys, _)) in enumerate(zip(chunk, crops, results)):
+            th, tw = crop.shape[:2]
+            for box, p in zip(boxes, polys):
+                l, top = box.min(axis=0)
+                r, bottom = box.max(axis=0)
+                cut = (l <= 2 and x0 > 0) or (top <= 2 and y0 > 0) or \
+                      (r >= tw - 3 and x0 + tw < img_w) or (bottom >= th - 3 and y0 + th < img_h)
+                dets.append((box + (x0, y0), p + (x0, y0), b + t, cut))
+
+    return mergeTileDetections(dets)
+
+def mergeTileDetections(dets):
+    # union detections from different tiles that are the same word: mostly contained in one
+    # another, or overlapping while one of them is cut by a tile seam
+    if len(dets) == 0:
+        return [], [], None
+    bounds = np.array([np.concatenate([d[0].min(axis=0), d[0].max(axis=0)]) for d in dets])
+    tile = np.array([d[2] for d in dets])
+    cut = np.array([d[3] for d in dets])
+    area = np.prod(np.maximum(bounds[:, 2:] - bounds[:, :2], 1), axis=1)
+    iw = np.minimum(bounds[:, None, 2], bounds[None, :, 2]) - np.maximum(bounds[:, None, 0], bounds[None, :, 0])
+    ih = np.minimum(bounds[:, None, 3], bounds[None, :, 3]) - np.maximum(bounds[:, None, 1], bounds[None, :, 1])
+    inter = np.maximum(iw, 0) * np.maximum(ih, 0)
+    contained = inter / np.minimum(area[:, None], area[None, :]) >= 0.5
+    same = (tile[:, None] != tile[None, :]) & (inter > 0) & (contained | cut[:, None] | cut[None, :])
+
+    group = list(range(len(dets)))
+    def find(i):
+        while group[i] != i:
+            group[i] = group[group[i]]
+            i = group[i]
+        return i
+    for i, j in zip(*np.nonzero(np.triu(same, 1))):
+        group[find(i)] = find(j)
+
+    members = OrderedDict()
+    for i in range(len(dets)):
+        members.setdefault(find(i), []).append(i)
+    boxes, polys = [], []
+    for idx in members.values():
+        if len(idx) == 1:
+            boxes.append(dets[idx[0]][0]); polys.append(dets[idx[0]][1])
+            continue
+        box = cv2.boxPoints(cv2.minAreaRect(np.concatenate([dets[i][0] for i in idx]).astype(np.float32)))
+        box = np.roll(box, 4 - box.sum(axis=1).argmin(), 0)
+        boxes.append(box); polys.append(box)
+    return boxes, polys, None
+
 from PIL import Image
 
 def read_coordinates_from_file(filename):
@@ -120,31 +299,87 @@ def extract_and_save_images(image_path, coordinates_file, output_folder):
         region.save(output_path)
         print(f"Segmented image saved: {output_path}")
 
-def craftseg(image_path, trained_model='weights/craft_mlt_25k.pth', cuda=True):
-    # Load model
-    net = load_model(trained_model, cuda)
+def count_page(polys):
+    # pages and boxes counters, boxes per page is their ratio
+    metrics.inc('pages')
+    metrics.inc('boxes', len(polys))
 
+def crop_segments(image, polys, as_pil=True):
+    # crop the axis-aligned bounds of every detection straight from the decoded image
+    with metrics.timed('crop'):
+        if as_pil:
+            img = Image.fromarray(image)
+        segments = []
+        for poly in polys:
+            coords = np.array(poly).astype(np.int32).reshape(-1, 2)
+            l, t = coords.min(axis=0)
+            r, b = coords.max(axis=0)
+            if as_pil:
+                region = img.crop((l, t, r, b))
+            else:
+                region = image[max(t, 0):max(b, 0), max(l, 0):max(r, 0)]
+            segments.append((region, coords.reshape(-1)))
+    metrics.inc('crops', len(segments))
+    return segments
+
+def save_segments(segments, output_folder):
+    os.makedirs(output_folder, exist_ok=True)
+    for i, (region, coords) in enumerate(segments):
+        if not isinstance(region, Image.Image):
+            region = Image.fromarray(region)
+        output_path = f"{output_folder}/segment_{i}.png"
+        region.save(output_path)
+        print(f"Segmented image saved: {output_path}")
+
+def detect_image(image, trained_model='weights/craft_mlt_25k.pth', cuda=True, refiner_model=None, backend='torch', cache=None,
+                 render=False):
+    # process_image with the craftseg settings through the shared model registry; with a
+    # det_cache.DetectionCache, a document seen before skips CRAFT (no heatmap on a hit)
+    key = None
+    if cache is not None:
+        import det_cache
+        params = dict(text_threshold=0.7, link_threshold=0.4, low_text=0.4, canvas_size=1280, mag_ratio=1.5, poly=refiner_model is not None)
+        key = det_cache.cache_key(image, det_cache.model_id(trained_model, refiner_model, backend), params)
+        hit = cache.get(key)
+        if hit is not None:
+            return hit[0], hit[1], None
+
+    net, refine_net = get_models(trained_model, cuda, refiner_model, backend)
+    bboxes, polys, score_text = process_image(net, image, 0.7, 0.4, 0.4, cuda, refine_net is not None, refine_net, render=render)
+    if key is not None:
+        cache.put(key, bboxes, polys)
+    return bboxes, polys, score_text
+
+def detect_segments(image, trained_model='weights/craft_mlt_25k.pth', cuda=True, refiner_model=None, as_pil=True, output_folder=None,
+                    backend='torch', cache=None):
+    # image (RGB array) -> [(crop, box)], disk output only when output_folder is given
+    bboxes, polys, score_text = detect_image(image, trained_model, cuda, refiner_model, backend, cache=cache)
+    count_page(polys)
+    segments = crop_segments(image, polys, as_pil)
+    if output_folder is not None:
+        save_segments(segments, output_folder)
+    return segments
+
+def craftseg(image_path, trained_model='weights/craft_mlt_25k.pth', cuda=True, refiner_model=None, backend='torch',
+             output_policy='debug', cache=None):
     # Load image
     image = imgproc.loadImage(image_path)
 
-    # Process image
-    bboxes, polys, score_text = process_image(net, image, 0.7, 0.4, 0.4, cuda, False)
+    # Process image (model shared across calls, result cached when a DetectionCache is given)
+    bboxes, polys, score_text = detect_image(image, trained_model, cuda, refiner_model, backend, cache, render=output_policy == 'debug')
+    count_page(polys)
 
-    # Save results
+    # Save results; 'none' writes nothing, the segment_<i>.png crops are debug output
     result_folder = './result/'
-    if not os.path.isdir(result_folder):
+    if output_policy != 'none' and not os.path.isdir(result_folder):
         os.mkdir(result_folder)
+    file_utils.saveOutput(image_path, image, polys, score_text, result_folder, output_policy)
 
-    filename, file_ext = os.path.splitext(os.path.basename(image_path))
-    mask_file = result_folder + "/res_" + filename + '_mask.jpg'
-    cv2.imwrite(mask_file, score_text)
-    file_utils.saveResult(image_path, image[:, :, ::-1], polys, dirname=result_folder)
-    
-    # Use the saved result coordinates file directly
-    coordinates_file = result_folder + "/res_" + filename + '.txt'
-    
-    # Pass image_path, coordinates_file, and output_folder to your extraction function
-    extract_and_save_images(image_path, coordinates_file, result_folder)
+    # Crop from the decoded image instead of reading the coordinates file back
+    segments = crop_segments(image, polys)
+    if output_policy == 'debug':
+        save_segments(segments, result_folder)
+    return segments
 
 if __name__ == '__main__':
     import argparse
@@ -152,6 +387,15 @@ if __name__ == '__main__':
     parser.add_argument('--trained_model', default='weights/craft_mlt_25k.pth', type=str, help='pretrained model')
     parser.add_argument('--image_path', required=True, type=str, help='path to a single input image')
     parser.add_argument('--cuda', default=True, type=bool, help='Use cuda for inference')
+    parser.add_argument('--refiner_model', default=None, type=str, help='pretrained refiner model (enables link refiner)')
+    parser.add_argument('--backend', default='torch', choices=onnx_backend.BACKENDS, help='inference engine for the detector')
+    parser.add_argument('--output_policy', default='debug', choices=file_utils.OUTPUT_POLICIES,
+                        help='none: no files, coords: res_<name>.txt only, debug: also the annotated image, score heatmap and segment crops')
+    parser.add_argument('--cache', default=None, type=str, help='SQLite detection cache, e.g. weights/detections.sqlite')
     args = parser.parse_args()
 
-    craftseg(args.image_path, args.trained_model, args.cuda)
\ No newline at end of file
+    cache = None
+    if args.cache:
+        from det_cache import DetectionCache
+        cache = DetectionCache(args.cache)
+    craftseg(args.image_path, args.trained_model, args.cuda, args.refiner_model, args.backend, args.output_policy, cache)
\ No newline at end of file
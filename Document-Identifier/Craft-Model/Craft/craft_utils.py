@@ -7,13 +7,34 @@ import math
 def warpCoord(Minv, pt):
     out = np.matmul(Minv, (pt[0], pt[1], 1))
     return np.array([out[0]/out[2], out[1]/out[2]])
+
+# test segments (rows of [x0, y0, x1, y1]) against a binary map, sampling the pixels cv2.line would draw
+def lineOverlaps(binmap, lines):
+    h, w = binmap.shape
+    ends = np.zeros((len(lines), 4), dtype=np.int64)
+    valid = np.zeros(len(lines), dtype=bool)
+    for i, p in enumerate(lines):
+        valid[i], p0, p1 = cv2.clipLine((0, 0, w, h), (int(p[0]), int(p[1])), (int(p[2]), int(p[3])))
+        if valid[i]: ends[i] = p0 + p1
+
+    # bresenham walk, left to right along the major axis
+    swap = ends[:, 2] < ends[:, 0]
+    ends[swap] = ends[swap][:, [2, 3, 0, 1]]
+    dx, dy = ends[:, 2] - ends[:, 0], ends[:, 3] - ends[:, 1]
+    sy = np.where(dy < 0, -1, 1)
+    steep = np.abs(dy) > dx
+    major, minor = np.maximum(dx, np.abs(dy))[:, None], np.minimum(dx, np.abs(dy))[:, None]
+    k = np.minimum(np.arange(major.max() + 1), major)
+    m = np.maximum(0, -((major - 2 * minor * k) // np.maximum(2 * major, 1)))
+    xs = ends[:, 0, None] + np.where(steep[:, None], m, k)
+    ys = ends[:, 1, None] + sy[:, None] * np.where(steep[:, None], k, m)
+    return binmap[ys, xs].any(axis=1) & valid
+
 """ end of auxilary functions """
 
 
 def getDetBoxes_core(textmap, linkmap, text_threshold, link_threshold, low_text):
     # prepare data
-    linkmap = linkmap.copy()
-    textmap = textmap.copy()
     img_h, img_w = textmap.shape
 
     """ labeling method """
@@ -23,6 +44,9 @@ def getDetBoxes_core(textmap, linkmap, text_threshold, link_threshold, low_text)
     text_score_comb = np.clip(text_score + link_score, 0, 1)
     nLabels, labels, stats, centroids = cv2.connectedComponentsWithStats(text_score_comb.astype(np.uint8), connectivity=4)
 
+    # link area is removed from every segmentation map, so build it once
+    link_area = np.logical_and(link_score == 1, text_score == 0)
+
     det = []
     mapper = []
     for k in range(1,nLabels):
@@ -30,15 +54,12 @@ def getDetBoxes_core(textmap, linkmap, text_threshold, link_threshold, low_text)
         size = stats[k, cv2.CC_STAT_AREA]
         if size < 10: continue
 
-        # thresholding
-        if np.max(textmap[labels==k]) < text_threshold: continue
-
-        # make segmentation map
-        segmap = np.zeros(textmap.shape, dtype=np.uint8)
-        segmap[labels==k] = 255
-        segmap[np.logical_and(link_score==1, text_score==0)] = 0   # remove link area
         x, y = stats[k, cv2.CC_STAT_LEFT], stats[k, cv2.CC_STAT_TOP]
         w, h = stats[k, cv2.CC_STAT_WIDTH], stats[k, cv2.CC_STAT_HEIGHT]
+
+        # thresholding
+        if np.max(textmap[y:y+h, x:x+w][labels[y:y+h, x:x+w] == k]) < text_threshold: continue
+
         niter = int(math.sqrt(size * min(w, h) / (w * h)) * 2)
         sx, ex, sy, ey = x - niter, x + w + niter + 1, y - niter, y + h + niter + 1
         # boundary check
@@ -46,11 +67,17 @@ def getDetBoxes_core(textmap, linkmap, text_threshold, link_threshold, low_text)
         if sy < 0 : sy = 0
         if ex >= img_w: ex = img_w
         if ey >= img_h: ey = img_h
+
+        # make segmentation map, local to the component box plus its dilation margin
+        segmap = np.zeros((ey - sy, ex - sx), dtype=np.uint8)
+        segmap[labels[sy:ey, sx:ex] == k] = 255
+        segmap[link_area[sy:ey, sx:ex]] = 0   # remove link area
         kernel = cv2.getStructuringElement(cv2.MORPH_RECT,(1 + niter, 1 + niter))
-        segmap[sy:ey, sx:ex] = cv2.dilate(segmap[sy:ey, sx:ex], kernel)
+        segmap = cv2.dilate(segmap, kernel)
 
         # make box
         np_contours = np.roll(np.array(np.where(segmap!=0)),1,axis=0).transpose().reshape(-1,2)
+        np_contours += (sx, sy)
         rectangle = cv2.minAreaRect(np_contours)
         box = cv2.boxPoints(rectangle)
 
@@ -80,7 +107,11 @@ def getPoly_core(boxes, labels, mapper, linkmap):
     max_r = 2.0
     step_r = 0.2
 
-    polys = []  
+    tot_seg = num_cp * 2 + 1
+    radii = np.arange(0.5, max_r, step_r)
+    last_r = radii + 2 * step_r >= max_r    # probe accepted regardless of overlap
+
+    polys = []
     for k, box in enumerate(boxes):
         # size filter for small instance
         w, h = int(np.linalg.norm(box[0] - box[1]) + 1), int(np.linalg.norm(box[1] - box[2]) + 1)
@@ -97,124 +128,84 @@ def getPoly_core(boxes, labels, mapper, linkmap):
             polys.append(None); continue
 
         # binarization for selected label
-        cur_label = mapper[k]
-        word_label[word_label != cur_label] = 0
-        word_label[word_label > 0] = 1
+        word_label = word_label == mapper[k]
 
         """ Polygon generation """
         # find top/bottom contours
-        cp = []
-        max_len = -1
-        for i in range(w):
-            region = np.where(word_label[:,i] != 0)[0]
-            if len(region) < 2 : continue
-            cp.append((i, region[0], region[-1]))
-            length = region[-1] - region[0] + 1
-            if length > max_len: max_len = length
+        cols = np.nonzero(word_label.sum(axis=0) >= 2)[0]
+        if len(cols) == 0:
+            polys.append(None); continue
+        top = word_label.argmax(axis=0)[cols]
+        bottom = h - 1 - word_label[::-1].argmax(axis=0)[cols]
+        cur_h = bottom - top + 1
+        cy = (top + bottom) * 0.5
 
         # pass if max_len is similar to h
-        if h * max_len_ratio < max_len:
+        if h * max_len_ratio < cur_h.max():
             polys.append(None); continue
 
-        # get pivot points with fixed length
-        tot_seg = num_cp * 2 + 1
+        # assign columns to segments of fixed width; a column moves at most one segment past the previous column
         seg_w = w / tot_seg     # segment width
-        pp = [None] * num_cp    # init pivot points
-        cp_section = [[0, 0]] * tot_seg
-        seg_height = [0] * num_cp
-        seg_num = 0
-        num_sec = 0
-        prev_h = -1
-        for i in range(0,len(cp)):
-            (x, sy, ey) = cp[i]
-            if (seg_num + 1) * seg_w <= x and seg_num <= tot_seg:
-                # average previous segment
-                if num_sec == 0: break
-                cp_section[seg_num] = [cp_section[seg_num][0] / num_sec, cp_section[seg_num][1] / num_sec]
-                num_sec = 0
-
-                # reset variables
-                seg_num += 1
-                prev_h = -1
-
-            # accumulate center points
-            cy = (sy + ey) * 0.5
-            cur_h = ey - sy + 1
-            cp_section[seg_num] = [cp_section[seg_num][0] + x, cp_section[seg_num][1] + cy]
-            num_sec += 1
-
-            if seg_num % 2 == 0: continue # No polygon area
-
-            if prev_h < cur_h:
-                pp[int((seg_num - 1)/2)] = (x, cy)
-                seg_height[int((seg_num - 1)/2)] = cur_h
-                prev_h = cur_h
-
-        # processing last segment
-        if num_sec != 0:
-            cp_section[-1] = [cp_section[-1][0] / num_sec, cp_section[-1][1] / num_sec]
-
-        # pass if num of pivots is not sufficient or segment widh is smaller than character height 
-        if None in pp or seg_w < np.max(seg_height) * 0.25:
+        reached = np.searchsorted(np.arange(1, tot_seg + 1) * seg_w, cols, side='right')
+        if reached[0] > 0:
+            polys.append(None); continue
+        idx = np.arange(len(cols))
+        seg = idx + np.minimum.accumulate(reached - idx)
+
+        # pass if num of pivots is not sufficient
+        if seg[-1] < tot_seg - 2:
+            polys.append(None); continue
+
+        # average center points of every completed segment, the trailing one lands in the last slot
+        cnt = np.bincount(seg, minlength=tot_seg)
+        cp_section = np.stack([np.bincount(seg, weights=cols, minlength=tot_seg),
+                               np.bincount(seg, weights=cy, minlength=tot_seg)], axis=1)
+        done = np.arange(tot_seg) < seg[-1]
+        cp_section[done] /= cnt[done, None]
+        if seg[-1] == tot_seg - 1:
+            cp_section[-1] /= cnt[-1]
+
+        # get pivot points: tallest (first) column of every odd segment
+        order = np.lexsort((idx, -cur_h, seg))
+        first = order[np.r_[True, seg[order][1:] != seg[order][:-1]]]
+        pivot = first[1::2][:num_cp]
+        pp_x, pp_y, seg_height = cols[pivot], cy[pivot], cur_h[pivot]
+
+        # pass if segment widh is smaller than character height
+        if seg_w < np.max(seg_height) * 0.25:
             polys.append(None); continue
 
         # calc median maximum of pivot points
         half_char_h = np.median(seg_height) * expand_ratio / 2
 
         # calc gradiant and apply to make horizontal pivots
-        new_pp = []
-        for i, (x, cy) in enumerate(pp):
-            dx = cp_section[i * 2 + 2][0] - cp_section[i * 2][0]
-            dy = cp_section[i * 2 + 2][1] - cp_section[i * 2][1]
-            if dx == 0:     # gradient if zero
-                new_pp.append([x, cy - half_char_h, x, cy + half_char_h])
-                continue
-            rad = - math.atan2(dy, dx)
-            c, s = half_char_h * math.cos(rad), half_char_h * math.sin(rad)
-            new_pp.append([x - s, cy - c, x + s, cy + c])
-
-        # get edge points to cover character heatmaps
-        isSppFound, isEppFound = False, False
-        grad_s = (pp[1][1] - pp[0][1]) / (pp[1][0] - pp[0][0]) + (pp[2][1] - pp[1][1]) / (pp[2][0] - pp[1][0])
-        grad_e = (pp[-2][1] - pp[-1][1]) / (pp[-2][0] - pp[-1][0]) + (pp[-3][1] - pp[-2][1]) / (pp[-3][0] - pp[-2][0])
-        for r in np.arange(0.5, max_r, step_r):
-            dx = 2 * half_char_h * r
-            if not isSppFound:
-                line_img = np.zeros(word_label.shape, dtype=np.uint8)
-                dy = grad_s * dx
-                p = np.array(new_pp[0]) - np.array([dx, dy, dx, dy])
-                cv2.line(line_img, (int(p[0]), int(p[1])), (int(p[2]), int(p[3])), 1, thickness=1)
-                if np.sum(np.logical_and(word_label, line_img)) == 0 or r + 2 * step_r >= max_r:
-                    spp = p
-                    isSppFound = True
-            if not isEppFound:
-                line_img = np.zeros(word_label.shape, dtype=np.uint8)
-                dy = grad_e * dx
-                p = np.array(new_pp[-1]) + np.array([dx, dy, dx, dy])
-                cv2.line(line_img, (int(p[0]), int(p[1])), (int(p[2]), int(p[3])), 1, thickness=1)
-                if np.sum(np.logical_and(word_label, line_img)) == 0 or r + 2 * step_r >= max_r:
-                    epp = p
-                    isEppFound = True
-            if isSppFound and isEppFound:
-                break
+        dx = cp_section[2::2, 0] - cp_section[:-2:2, 0]
+        dy = cp_section[2::2, 1] - cp_section[:-2:2, 1]
+        rad = - np.arctan2(dy, dx)
+        c = np.where(dx == 0, half_char_h, half_char_h * np.cos(rad))
+        s = np.where(dx == 0, 0, half_char_h * np.sin(rad))
+        new_pp = np.stack([pp_x - s, pp_y - c, pp_x + s, pp_y + c], axis=1)
+
+        # get edge points to cover character heatmaps, probing every radius at once
+        grad_s = (pp_y[1] - pp_y[0]) / (pp_x[1] - pp_x[0]) + (pp_y[2] - pp_y[1]) / (pp_x[2] - pp_x[1])
+        grad_e = (pp_y[-2] - pp_y[-1]) / (pp_x[-2] - pp_x[-1]) + (pp_y[-3] - pp_y[-2]) / (pp_x[-3] - pp_x[-2])
+        step = 2 * half_char_h * radii
+        sp = new_pp[0] - np.stack([step, grad_s * step, step, grad_s * step], axis=1)
+        ep = new_pp[-1] + np.stack([step, grad_e * step, step, grad_e * step], axis=1)
+        free = ~lineOverlaps(word_label, np.concatenate([sp, ep])) | np.tile(last_r, 2)
+        s_idx, e_idx = np.argmax(free[:len(radii)]), np.argmax(free[len(radii):])
 
         # pass if boundary of polygon is not found
-        if not (isSppFound and isEppFound):
+        if not (free[s_idx] and free[len(radii) + e_idx]):
             polys.append(None); continue
+        spp, epp = sp[s_idx], ep[e_idx]
 
         # make final polygon
-        poly = []
-        poly.append(warpCoord(Minv, (spp[0], spp[1])))
-        for p in new_pp:
-            poly.append(warpCoord(Minv, (p[0], p[1])))
-        poly.append(warpCoord(Minv, (epp[0], epp[1])))
-        poly.append(warpCoord(Minv, (epp[2], epp[3])))
-        for p in reversed(new_pp):
-            poly.append(warpCoord(Minv, (p[2], p[3])))
-        poly.append(warpCoord(Minv, (spp[2], spp[3])))
+        poly = np.concatenate([spp[None, :2], new_pp[:, :2], epp[None, :2], epp[None, 2:], new_pp[::-1, 2:], spp[None, 2:]])
+        poly = np.matmul(np.hstack([poly, np.ones((len(poly), 1))]), Minv.T)
 
         # add to final result
-        polys.append(np.array(poly))
+        polys.append(poly[:, :2] / poly[:, 2:])
 
     return polys
 
@@ -235,3 +226,24 @@ def adjustResultCoordinates(polys, ratio_w, ratio_h, ratio_net = 2):
             if polys[k] is not None:
                 polys[k] *= (ratio_w * ratio_net, ratio_h * ratio_net)
     return polys
+
+def polyIoU(poly_a, poly_b):
+    poly_a, poly_b = np.float32(poly_a).reshape(-1, 2), np.float32(poly_b).reshape(-1, 2)
+    inter, _ = cv2.intersectConvexConvex(cv2.convexHull(poly_a), cv2.convexHull(poly_b))
+    union = cv2.contourArea(poly_a) + cv2.contourArea(poly_b) - inter
+    return inter / union if union > 0 else 0.0
+
+def matchBoxes(ref_boxes, test_boxes, iou_threshold=0.5):
+    # greedy one-to-one matching by IoU, returns the number of matched pairs
+    pairs = []
+    for i, a in enumerate(ref_boxes):
+        for j, b in enumerate(test_boxes):
+            iou = polyIoU(a, b)
+            if iou >= iou_threshold:
+                pairs.append((iou, i, j))
+    used_ref, used_test = set(), set()
+    for iou, i, j in sorted(pairs, reverse=True):
+        if i not in used_ref and j not in used_test:
+            used_ref.add(i)
+            used_test.add(j)
+    return len(used_ref)
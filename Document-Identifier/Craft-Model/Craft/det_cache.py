@@ -0,0 +1,143 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+
+import numpy as np
+
+import metrics
+
+# weights digest per (path, size, mtime), so each checkpoint is hashed once per process
+_weights_ids = {}
+_weights_lock = threading.Lock()
+
+def weights_id(path):
+    st = os.stat(path)
+    stamp = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    with _weights_lock:
+        if stamp not in _weights_ids:
+            h = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    h.update(block)
+            _weights_ids[stamp] = h.hexdigest()
+        return _weights_ids[stamp]
+
+def model_id(trained_model, refiner_model=None, backend='torch'):
+    parts = [backend, weights_id(trained_model)]
+    if refiner_model:
+        parts.append(weights_id(refiner_model))
+    return ':'.join(parts)
+
+def cache_key(data, model, params):
+    """ content address of one detection
+    Args:
+        data (bytes or array): encoded file bytes, or a decoded image (hashed with its shape)
+        model (str): model_id() of the detector and refiner
+        params (dict): every setting that changes the boxes (thresholds, canvas_size, mag_ratio, poly, ...)
+    """
+    h = hashlib.sha256()
+    if isinstance(data, np.ndarray):
+        h.update(repr((data.shape, data.dtype.str)).encode())
+        data = np.ascontiguousarray(data)
+    h.update(memoryview(data).cast('B'))
+    h.update(model.encode())
+    h.update(json.dumps(params, sort_keys=True).encode())
+    return h.hexdigest()
+
+def _encode(polys):
+    return json.dumps([np.asarray(p, dtype=np.float32).tolist() for p in polys])
+
+def _decode(text):
+    return [np.array(p, dtype=np.float32) for p in json.loads(text)]
+
+# hits whose last_used is written in one transaction
+TOUCH_BATCH = 256
+# own inserts before the row count is read from the database again (other processes insert too)
+COUNT_RESYNC = 1000
+
+class DetectionCache:
+    """ persistent boxes/polys per content address, least recently used entries evicted past max_entries
+
+    Backed by one SQLite file in WAL mode, so folder_runner workers and service threads can share it.
+    Hits only read; their last_used times are written TOUCH_BATCH at a time (and at close), and
+    eviction removes a chunk of the oldest rows at once, so the database is not written per lookup.
+    """
+    def __init__(self, path='weights/detections.sqlite', max_entries=100000):
+        self.path = path
+        self.max_entries = max_entries
+        self.evict_chunk = max(1, max_entries // 100)
+        self.hits = 0
+        self.misses = 0
+        self.touched = {}       # key -> last_used not yet written
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS detections (key TEXT PRIMARY KEY, boxes TEXT, polys TEXT, last_used REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS detections_last_used ON detections (last_used)')
+        self.db.commit()
+        self._sync_count()
+
+    def _sync_count(self):
+        self.count = self.db.execute('SELECT COUNT(*) FROM detections').fetchone()[0]
+        self.inserts = 0
+
+    def _flush_touched(self):
+        if self.touched:
+            self.db.executemany('UPDATE detections SET last_used = ? WHERE key = ?', [(t, k) for k, t in self.touched.items()])
+            self.db.commit()
+            self.touched.clear()
+
+    def get(self, key):
+        # (boxes, polys) or None
+        with self.lock:
+            row = self.db.execute('SELECT boxes, polys FROM detections WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.touched[key] = time.time()
+                if len(self.touched) >= TOUCH_BATCH:
+                    self._flush_touched()
+        metrics.inc('cache_hits' if row is not None else 'cache_misses')
+        if row is None:
+            return None
+        return np.array(_decode(row[0]), dtype=np.float32).reshape(-1, 4, 2), _decode(row[1])
+
+    def put(self, key, boxes, polys):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO detections VALUES (?, ?, ?, ?)', (key, _encode(boxes), _encode(polys), time.time()))
+            self.count += 1
+            self.inserts += 1
+            if self.count > self.max_entries or self.inserts >= COUNT_RESYNC:
+                self._sync_count()
+            if self.count > self.max_entries:
+                # recent hits count as used before the oldest rows go
+                self._flush_touched()
+                evict = self.count - self.max_entries + self.evict_chunk
+                self.db.execute('DELETE FROM detections WHERE key IN '
+                                '(SELECT key FROM detections ORDER BY last_used LIMIT ?)', (evict,))
+                self.count = max(self.count - evict, 0)
+            self.db.commit()
+
+    def stats(self):
+        with self.lock:
+            self._sync_count()
+            entries = self.count
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': entries, 'max_entries': self.max_entries}
+
+    def clear(self):
+        with self.lock:
+            self.db.execute('DELETE FROM detections')
+            self.db.commit()
+            self.touched.clear()
+            self._sync_count()
+
+    def close(self):
+        with self.lock:
+            self._flush_touched()
+            self.db.close()
@@ -0,0 +1,100 @@
+import json
+import functools
+
+from rapidfuzz import fuzz
+
+# document_type values as schema.json spells them
+DOC_TYPES = ('PAN', 'Aadhar', 'Passport', 'Driving')
+
+# printed headings per card, matched fuzzily against the OCR text (OCR drops and merges letters)
+KEYWORDS = {
+    'PAN': ('INCOME TAX DEPARTMENT', 'PERMANENT ACCOUNT NUMBER', 'आयकर विभाग'),
+    'Aadhar': ('AADHAAR', 'UNIQUE IDENTIFICATION AUTHORITY OF INDIA', 'MERA AADHAAR MERI PEHCHAN', 'आधार', 'मेरा आधार'),
+    'Passport': ('REPUBLIC OF INDIA', 'PASSPORT', 'P<IND', 'PLACE OF ISSUE', 'FILE NO'),
+    'Driving': ('DRIVING LICENCE', 'DRIVING LICENSE', 'TRANSPORT DEPARTMENT', 'VALID TILL', 'AUTHORISATION TO DRIVE'),
+}
+
+# below this partial_ratio a keyword does not count as present
+MIN_SCORE = 80
+
+# below this classify() score the type is not even kept as a guess; cutting the prompt down to one
+# card type takes the caller's min_confidence (several clear headings)
+MIN_CONFIDENCE = 0.45
+
+# schema.json fields printed on each card type, with the short hint sent instead of the full description
+FIELDS = {
+    'PAN': {
+        'document_id': 'PAN, 10 characters',
+        'name': 'card holder name',
+        'dob': 'DD/MM/YY',
+    },
+    'Aadhar': {
+        'document_id': '12 digit Aadhaar number',
+        'name': 'card holder name',
+        'dob': 'DD/MM/YY',
+        'gender': 'M/F',
+        'address': 'full address',
+        'mobile': 'mobile number',
+    },
+    'Passport': {
+        'document_id': 'passport number',
+        'name': 'given names and surname',
+        'dob': 'DD/MM/YY',
+        'gender': 'M/F',
+        'address': 'full address',
+        'doi': 'date of issue, DD/MM/YY',
+        'doe': 'date of expiry, DD/MM/YY',
+        'place_of_issue': 'place of issue',
+    },
+    'Driving': {
+        'document_id': 'licence number',
+        'name': 'holder name',
+        'dob': 'DD/MM/YY',
+        'address': 'full address',
+        'doi': 'date of issue, DD/MM/YY',
+        'doe': 'valid till, DD/MM/YY',
+        'place_of_issue': 'issuing authority',
+    },
+}
+
+LABELS = {'PAN': 'PAN card', 'Aadhar': 'Aadhaar card', 'Passport': 'passport', 'Driving': 'driving licence'}
+
+def _score(keyword, text):
+    # partial_ratio slides the shorter string over the longer one; a keyword longer than the
+    # whole text must not match the text as one of its substrings
+    if len(text) < len(keyword):
+        return fuzz.ratio(keyword, text)
+    return fuzz.partial_ratio(keyword, text)
+
+def classify(text):
+    """ cheap document type guess from the OCR text
+    Return:
+        (document_type, confidence in [0, 1]), (None, 0.0) when no keyword reaches MIN_SCORE
+    """
+    upper = text.upper()
+    best, best_score = None, 0.0
+    for doc_type, keywords in KEYWORDS.items():
+        scores = sorted((_score(keyword, upper) for keyword in keywords), reverse=True)
+        hits = [s for s in scores if s >= MIN_SCORE]
+        if not hits:
+            continue
+        # the best heading decides, every further heading found adds a little certainty
+        score = hits[0] / 100 * (1 - 0.5 ** len(hits))
+        if score > best_score:
+            best, best_score = doc_type, score
+    return best, best_score
+
+def schema_for(doc_type, schema):
+    # compact per-type schema: only the fields the card carries; the full schema for unknown types
+    if doc_type not in FIELDS:
+        return dict(schema)
+    return {field: hint for field, hint in FIELDS[doc_type].items() if field in schema}
+
+@functools.lru_cache(maxsize=64)
+def _preamble(doc_type, fields_json):
+    return ("Extract fields from the OCR text of an Indian {}. Reply with one JSON object with exactly these keys, "
+            "null when absent: {}").format(LABELS.get(doc_type, 'identity document'), fields_json)
+
+def preamble(doc_type, schema):
+    # short system prompt, identical for every document of a type and field set
+    return _preamble(doc_type, json.dumps(schema, ensure_ascii=False, separators=(',', ':')))
@@ -4,6 +4,9 @@ import numpy as np
 import cv2
 import imgproc
 
+# none: nothing written, coords: res_<name>.txt only, debug: also res_<name>.jpg and the score heatmap
+OUTPUT_POLICIES = ('none', 'coords', 'debug')
+
 # borrowed from https://github.com/lengstrom/fast-style-transfer/blob/master/src/utils.py
 def get_files(img_dir):
     imgs, masks, xmls = list_files(img_dir)
@@ -25,21 +28,25 @@ def list_files(in_path):
                 gt_files.append(os.path.join(dirpath, file))
             elif ext == '.zip':
                 continue
-    # img_files.sort()
-    # mask_files.sort()
-    # gt_files.sort()
+    img_files.sort()
+    mask_files.sort()
+    gt_files.sort()
     return img_files, mask_files, gt_files
 
-def saveResult(img_file, img, boxes, dirname='./result/', verticals=None, texts=None):
+def saveResult(img_file, img, boxes, dirname='./result/', verticals=None, texts=None, draw=True):
         """ save text detection result one by one
         Args:
             img_file (str): image file name
             img (array): raw image context
             boxes (array): array of result file
                 Shape: [num_detections, 4] for BB output / [num_detections, 4] for QUAD output
+            draw (bool): also write the annotated copy of img (res_<name>.jpg)
         Return:
             None
         """
+        if not draw:
+            saveCoordinates(img_file, boxes, dirname)
+            return
         img = np.array(img)
 
         # make result file list
@@ -74,3 +81,29 @@ def saveResult(img_file, img, boxes, dirname='./result/', verticals=None, texts=
         # Save result image
         cv2.imwrite(res_img_file, img)
 
+
+def saveCoordinates(img_file, boxes, dirname='./result/'):
+    # res_<name>.txt only, no copy of the image
+    filename, file_ext = os.path.splitext(os.path.basename(img_file))
+    if not os.path.isdir(dirname):
+        os.mkdir(dirname)
+    with open(dirname + "res_" + filename + '.txt', 'w') as f:
+        for box in boxes:
+            poly = np.array(box).astype(np.int32).reshape((-1))
+            f.write(','.join([str(p) for p in poly]) + '\r\n')
+
+def saveOutput(img_file, image, boxes, score_text=None, dirname='./result/', policy='debug'):
+    """ write the detection artifacts selected by policy (see OUTPUT_POLICIES)
+    Args:
+        image (array): decoded RGB image, only read for the debug annotation (may be None otherwise)
+        score_text (array): heatmap from postprocess(render=True), or None
+    """
+    if policy not in OUTPUT_POLICIES:
+        raise ValueError("unknown output policy: " + str(policy))
+    if policy == 'none':
+        return
+    draw = policy == 'debug'
+    saveResult(img_file, image[:, :, ::-1] if draw else None, boxes, dirname=dirname, draw=draw)
+    if policy == 'debug' and score_text is not None:
+        filename, file_ext = os.path.splitext(os.path.basename(img_file))
+        cv2.imwrite(dirname + "/res_" + filename + '_mask.jpg', score_text)
@@ -0,0 +1,119 @@
+import os
+import json
+import time
+import hashlib
+import multiprocessing
+
+import cv2
+import torch
+
+import imgproc
+import file_utils
+import craft_module
+import det_cache
+
+# per-process state, filled by _init_worker
+_worker = {}
+
+def run_id(trained_model, refiner_model, backend, params):
+    # fingerprint of everything that changes the output, so a manifest only resumes the same run
+    model = det_cache.model_id(trained_model, refiner_model, backend)
+    return hashlib.sha1((model + json.dumps(params, sort_keys=True)).encode()).hexdigest()[:16]
+
+def read_manifest(manifest_file, run=None):
+    # completed image paths of this run; a line cut short by a crash is ignored
+    done = set()
+    if not manifest_file or not os.path.isfile(manifest_file):
+        return done
+    with open(manifest_file, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get('status') == 'done' and entry.get('run') == run:
+                done.add(entry['image'])
+    return done
+
+def _init_worker(trained_model, refiner_model, cuda, num_threads, params, backend, cache, cache_size):
+    torch.set_num_threads(num_threads)
+    cv2.setNumThreads(num_threads)
+    _worker['net'] = craft_module.load_model(trained_model, cuda, backend, num_threads)
+    _worker['refine_net'] = craft_module.load_refiner(refiner_model, cuda, backend, num_threads) if refiner_model else None
+    _worker['cuda'] = cuda
+    _worker['params'] = params
+    # one connection per worker to the shared detection cache (SQLite in WAL mode)
+    _worker['cache'] = det_cache.DetectionCache(cache, cache_size) if cache else None
+    _worker['cache_model'] = det_cache.model_id(trained_model, refiner_model, backend) if cache else None
+
+def _process(image_path):
+    p = _worker['params']
+    cache = _worker['cache']
+    try:
+        key = hit = None
+        if cache is not None:
+            with open(image_path, 'rb') as f:
+                key = det_cache.cache_key(f.read(), _worker['cache_model'], p['cache_params'])
+            hit = cache.get(key)
+        if hit is not None:
+            (bboxes, polys), score_text = hit, None
+            image = imgproc.loadImage(image_path) if p['output_policy'] == 'debug' else None
+        else:
+            image = imgproc.loadImage(image_path)
+            bboxes, polys, score_text = craft_module.process_images(
+                _worker['net'], [image], p['text_threshold'], p['link_threshold'], p['low_text'], _worker['cuda'], p['poly'],
+                _worker['refine_net'], canvas_size=p['canvas_size'], mag_ratio=p['mag_ratio'], render=p['output_policy'] == 'debug')[0]
+            if key is not None:
+                cache.put(key, bboxes, polys)
+        file_utils.saveOutput(image_path, image, polys, score_text, p['result_folder'], p['output_policy'])
+    except Exception as e:
+        return image_path, None, repr(e), False
+    return image_path, len(polys), None, hit is not None
+
+def run_folder(image_list, trained_model, result_folder, manifest_file, workers=2, threads_per_worker=1, cuda=False,
+               refiner_model=None, text_threshold=0.7, link_threshold=0.4, low_text=0.4, poly=False, canvas_size=1280, mag_ratio=1.5, backend='torch',
+               output_policy='coords', cache=None, cache_size=100000, cache_params=None):
+    """ detect text in image_list with `workers` processes, each holding its own CRAFT instance
+
+    With a manifest_file, finished images are appended to it (one JSON object per line) as they
+    complete, so a rerun with the same manifest, model and settings skips everything already done.
+    With a cache path, every worker looks images up in that det_cache.DetectionCache first;
+    cache_params are the settings in the key (test.py's detection_params()).
+    """
+    params = dict(text_threshold=text_threshold, link_threshold=link_threshold, low_text=low_text, poly=poly or refiner_model is not None,
+                  canvas_size=canvas_size, mag_ratio=mag_ratio, result_folder=result_folder, output_policy=output_policy)
+    run = run_id(trained_model, refiner_model, backend, params)
+    done = read_manifest(manifest_file, run)
+    todo = [path for path in sorted(image_list) if path not in done]
+    print("{:d} images, {:d} already done, {:d} to process".format(len(image_list), len(image_list) - len(todo), len(todo)))
+    if not todo:
+        return
+
+    if backend == 'onnx':
+        # export once here instead of racing in every worker
+        craft_module.load_model(trained_model, False, backend)
+        if refiner_model:
+            craft_module.load_refiner(refiner_model, False, backend)
+
+    params['cache_params'] = cache_params if cache_params is not None else {
+        name: params[name] for name in ('text_threshold', 'link_threshold', 'low_text', 'canvas_size', 'mag_ratio', 'poly')}
+    chunksize = max(1, min(16, len(todo) // (workers * 4)))
+    failed = hits = 0
+    t = time.time()
+    manifest = open(manifest_file, 'a') if manifest_file else None
+    with multiprocessing.Pool(workers, _init_worker, (trained_model, refiner_model, cuda, threads_per_worker, params, backend,
+                                                      cache, cache_size)) as pool:
+        for k, (image_path, num_boxes, error, cached) in enumerate(pool.imap_unordered(_process, todo, chunksize)):
+            hits += cached
+            if error is None:
+                entry = {'image': image_path, 'status': 'done', 'boxes': num_boxes, 'run': run}
+            else:
+                failed += 1
+                entry = {'image': image_path, 'status': 'failed', 'error': error, 'run': run}
+            if manifest is not None:
+                manifest.write(json.dumps(entry) + '\n')
+                manifest.flush()
+            print("Test image {:d}/{:d}: {:s}".format(k + 1, len(todo), image_path), end='\r')
+    if manifest is not None:
+        manifest.close()
+    print("\n{:d} images processed ({:d} failed, {:d} from the detection cache) in {:.1f}s".format(len(todo), failed, hits, time.time() - t))
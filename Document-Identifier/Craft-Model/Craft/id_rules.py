@@ -0,0 +1,136 @@
+import re
+from datetime import datetime
+
+# fields filled with at least this confidence are not sent to the LLM
+MIN_CONFIDENCE = 0.8
+
+# OCR output of the cards runs words together ("DEPARTMENTGOVT. OF INDIAD MANIKANDAN..."), so
+# anchors are matched on the upper-cased text with everything but letters removed
+ANCHORS = {
+    'pan': ('INCOMETAXDEPARTMENT', 'INCOMETAX', 'PERMANENTACCOUNTNUMBER'),
+    'aadhaar': ('AADHAAR', 'AADHAR', 'UNIQUEIDENTIFICATIONAUTHORITY', 'ENROLMENTNO'),
+    'government': ('GOVERNMENTOFINDIA', 'GOVTOFINDIA'),
+}
+_NON_LETTERS = re.compile(r'[^A-Z]')
+
+# 4th PAN character is the holder type (P: person, C: company, H: HUF, F: firm, ...)
+PAN_RE = re.compile(r'[A-Z]{3}([ABCFGHJLPT])[A-Z][0-9]{4}[A-Z]')
+# no further digit group on either side, so a 16 digit VID ("9123 4567 8901 2345") yields no 12 digit window
+AADHAAR_RE = re.compile(r'(?<!\d)(?<!\d[ -])([2-9]\d{3})[ -]?(\d{4})[ -]?(\d{4})(?![ -]?\d)')
+DATE_RE = re.compile(r'(?<!\d)(\d{2})[/\-.](\d{2})[/\-.](\d{4})(?!\d)')
+DOB_ANCHOR_RE = re.compile(r'DOB|DATE\s*OF\s*BIRTH|जन्म\s*तिथि', re.IGNORECASE)
+# whole words only, "MALE" inside a name (VIMALESH, KAMALESH) is not a gender
+GENDER_RE = re.compile(r'(?<![A-Z])(FEMALE|MALE)(?![A-Z])|महिला|पुरुष', re.IGNORECASE)
+# cards print "महिला / FEMALE" or "Gender: Male"; a bare English word is only a hint
+GENDER_ANCHOR_RE = re.compile(r'(/|GENDER|SEX)\s*:?\s*$', re.IGNORECASE)
+
+# Verhoeff dihedral group tables, used by UIDAI for the Aadhaar check digit
+_D = [
+    [0, 1, 2, 3, 4, 5, 6, 7, 8, 9], [1, 2, 3, 4, 0, 6, 7, 8, 9, 5], [2, 3, 4, 0, 1, 7, 8, 9, 5, 6],
+    [3, 4, 0, 1, 2, 8, 9, 5, 6, 7], [4, 0, 1, 2, 3, 9, 5, 6, 7, 8], [5, 9, 8, 7, 6, 0, 4, 3, 2, 1],
+    [6, 5, 9, 8, 7, 1, 0, 4, 3, 2], [7, 6, 5, 9, 8, 2, 1, 0, 4, 3], [8, 7, 6, 5, 9, 3, 2, 1, 0, 4],
+    [9, 8, 7, 6, 5, 4, 3, 2, 1, 0],
+]
+_P = [
+    [0, 1, 2, 3, 4, 5, 6, 7, 8, 9], [1, 5, 7, 6, 2, 8, 3, 0, 9, 4], [5, 8, 0, 3, 7, 9, 6, 1, 4, 2],
+    [8, 9, 1, 6, 0, 4, 3, 5, 2, 7], [9, 4, 5, 3, 1, 2, 6, 8, 7, 0], [4, 2, 8, 6, 5, 7, 3, 9, 0, 1],
+    [2, 7, 9, 3, 8, 0, 6, 4, 1, 5], [7, 0, 4, 6, 9, 1, 3, 2, 5, 8],
+]
+
+def verhoeff_valid(digits):
+    c = 0
+    for i, d in enumerate(reversed(digits)):
+        c = _D[c][_P[i % 8][int(d)]]
+    return c == 0
+
+def _date(match):
+    day, month, year = (int(v) for v in match.groups())
+    try:
+        date = datetime(year, month, day)
+    except ValueError:
+        return None
+    if not 1900 <= year <= datetime.now().year:
+        return None
+    return date.strftime('%d/%m/%y')     # schema.json asks for DD/MM/YY
+
+def find_pan(text):
+    # (pan, confidence) or None
+    m = PAN_RE.search(text)
+    if m is None:
+        return None
+    return m.group(0), 0.9 if m.group(1) == 'P' else 0.7
+
+def find_aadhaar(text):
+    # first 12 digit group that passes the Verhoeff check, as "XXXX XXXX XXXX"
+    for m in AADHAAR_RE.finditer(text):
+        digits = ''.join(m.groups())
+        if verhoeff_valid(digits):
+            return ' '.join(m.groups()), 0.95
+    return None
+
+def find_dob(text, document_type=None):
+    dates = [(m.start(), _date(m)) for m in DATE_RE.finditer(text)]
+    dates = [(pos, d) for pos, d in dates if d is not None]
+    if not dates:
+        return None
+    anchor = DOB_ANCHOR_RE.search(text)
+    if anchor is not None:
+        after = [(pos, d) for pos, d in dates if pos >= anchor.start()]
+        if after:
+            return after[0][1], 0.95
+    if document_type == 'PAN':
+        return dates[0][1], 0.85       # the only date printed on a PAN card
+    if len(dates) == 1:
+        return dates[0][1], 0.7
+    return dates[0][1], 0.4
+
+def find_gender(text):
+    # anchored matches first, FEMALE over MALE; unanchored ones stay below MIN_CONFIDENCE
+    best = None
+    for m in GENDER_RE.finditer(text):
+        word = m.group(0)
+        female = word.upper() == 'FEMALE' or word == 'महिला'
+        anchored = m.group(1) is None or GENDER_ANCHOR_RE.search(text[max(m.start() - 12, 0):m.start()]) is not None
+        candidate = (0.9 if anchored else 0.6, female)
+        if best is None or candidate > best:
+            best = candidate
+    if best is None:
+        return None
+    return 'F' if best[1] else 'M', best[0]
+
+def extract_rules(text):
+    """ deterministic extraction of the ID fields that have a fixed shape
+    Args:
+        text (str): OCR output of one document
+    Return:
+        dict field -> (value, confidence) for document_type, document_id, dob, gender; fields
+        that were not found are absent
+    """
+    squashed = _NON_LETTERS.sub('', text.upper())
+    anchored = {kind: any(a in squashed for a in anchors) for kind, anchors in ANCHORS.items()}
+
+    fields = {}
+    pan = find_pan(text)
+    aadhaar = find_aadhaar(text)
+    if pan is not None and (anchored['pan'] or aadhaar is None):
+        fields['document_type'] = ('PAN', 0.95 if anchored['pan'] else 0.7)
+        fields['document_id'] = (pan[0], pan[1] + 0.05 if anchored['pan'] else pan[1])
+    elif aadhaar is not None:
+        fields['document_type'] = ('Aadhar', 0.95 if anchored['aadhaar'] or anchored['government'] else 0.75)
+        fields['document_id'] = aadhaar
+    elif anchored['pan']:
+        fields['document_type'] = ('PAN', 0.6)
+    elif anchored['aadhaar']:
+        fields['document_type'] = ('Aadhar', 0.6)
+
+    dob = find_dob(text, fields.get('document_type', (None,))[0])
+    if dob is not None:
+        fields['dob'] = dob
+    gender = find_gender(text) if fields.get('document_type', (None,))[0] != 'PAN' else None     # PAN cards carry no gender
+    if gender is not None:
+        fields['gender'] = gender
+    return fields
+
+def missing_fields(rules, schema, min_confidence=MIN_CONFIDENCE):
+    # schema fields the LLM still has to fill
+    return [field for field in schema if field not in rules or rules[field][1] < min_confidence]
@@ -1,16 +1,41 @@
 import numpy as np
 from skimage import io
+from PIL import Image
 import cv2
+import metrics
 
 def loadImage(img_file):
-    img = io.imread(img_file)           # RGB order
-    if img.shape[0] == 2: img = img[0]
-    if len(img.shape) == 2 : img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
-    if img.shape[2] == 4:   img = img[:,:,:3]
-    img = np.array(img)
+    with metrics.timed('decode'):
+        img = io.imread(img_file)           # RGB order
+        if img.shape[0] == 2: img = img[0]
+        if len(img.shape) == 2 : img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
+        if img.shape[2] == 4:   img = img[:,:,:3]
+        img = np.array(img)
 
     return img
 
+def loadImageReduced(img_file, max_size=None):
+    """ decode no larger than needed for a detector that uses at most max_size pixels on the long side
+    JPEGs are decoded at 1/2, 1/4 or 1/8 scale in the DCT domain (PIL draft), so the full resolution
+    image is never built; other formats and small images go through loadImage.
+    Args:
+        max_size (float): long side the caller will use at most, e.g. canvas_size / mag_ratio; None: full size
+    Return:
+        img (RGB array), scale (decoded size / original size, divide coordinates by it)
+    """
+    if max_size is not None:
+        # only the reduced decode is timed here, loadImage times the full one
+        with Image.open(img_file) as im:
+            if im.format == 'JPEG' and max(im.size) > max_size:
+                with metrics.timed('decode'):
+                    orig_w = im.size[0]
+                    ratio = max_size / max(im.size)
+                    # draft keeps the decoded size at or above the requested one
+                    im.draft('RGB', (int(np.ceil(im.size[0] * ratio)), int(np.ceil(im.size[1] * ratio))))
+                    img = np.array(im.convert('RGB'))
+                return img, 1.0 / round(orig_w / img.shape[1])
+    return loadImage(img_file), 1.0
+
 def normalizeMeanVariance(in_img, mean=(0.485, 0.456, 0.406), variance=(0.229, 0.224, 0.225)):
     # should be RGB order
     img = in_img.copy().astype(np.float32)
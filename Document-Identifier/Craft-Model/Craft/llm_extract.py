@@ -0,0 +1,454 @@
+import os
+import json
+import random
+import asyncio
+import functools
+
+import httpx
+import ollama
+
+import metrics
+import id_rules
+import doc_types
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'schema.json')
+
+# worth another attempt: overloaded, restarting or timed out on the server side
+RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+
+# prompt plus reply tokens of one packed request; has to fit the server's context length (num_ctx)
+PACK_BUDGET = 2048
+
+@functools.lru_cache(maxsize=None)
+def _load_schema(path):
+    with open(path, 'r') as f:
+        return json.dumps(json.load(f))
+
+def load_schema(path=SCHEMA_PATH):
+    # parsed once per process, callers get their own copy
+    return json.loads(_load_schema(path))
+
+@functools.lru_cache(maxsize=32)
+def _preamble(schema_json):
+    return ("Convert the data given by the user into a JSON format using the following JSON schema:\n"
+            + json.dumps(json.loads(schema_json), indent=4)
+            + "\nReply with the JSON object only.")
+
+def schema_preamble(schema):
+    # identical system message for every document of a schema, so the server can reuse its prompt prefix
+    return _preamble(json.dumps(schema))
+
+def build_messages(text, schema, doc_type=None):
+    # a known document type gets the compact per-type prompt of doc_types
+    system = doc_types.preamble(doc_type, schema) if doc_type else schema_preamble(schema)
+    return [{'role': 'system', 'content': system}, {'role': 'user', 'content': text}]
+
+def estimate_tokens(text):
+    # rough count for budgeting, about 4 characters per token
+    return len(text) // 4 + 1
+
+PACKED_NOTE = ("\nThe user message holds several documents, each starting with a line '### <id>'. Reply with a JSON array "
+               "with one object per document, in the same order, holding its \"id\" and the keys above.")
+
+def packed_messages(docs, schema, doc_type=None):
+    # one request for docs = [(id, text), ...]: the single-document prompt plus a note on the format
+    system = build_messages('', schema, doc_type)[0]['content'] + PACKED_NOTE
+    user = '\n\n'.join('### {}\n{}'.format(doc_id, text) for doc_id, text in docs)
+    return [{'role': 'system', 'content': system}, {'role': 'user', 'content': user}]
+
+def pack(docs, schema, doc_type=None, budget=PACK_BUDGET):
+    """ split docs = [(id, text), ...] into groups whose packed request fits the token budget
+    Return:
+        list of lists of (id, text); a document too large for the budget is a group of its own
+    """
+    overhead = estimate_tokens(packed_messages([], schema, doc_type)[0]['content'])
+    reply = estimate_tokens(json.dumps(dict({'id': '0000'}, **{field: 'x' * 24 for field in schema})))
+    groups, group, used = [], [], overhead
+    for doc_id, text in docs:
+        cost = estimate_tokens('### {}\n{}\n\n'.format(doc_id, text)) + reply
+        if group and used + cost > budget:
+            groups.append(group)
+            group, used = [], overhead
+        group.append((doc_id, text))
+        used += cost
+    if group:
+        groups.append(group)
+    return groups
+
+class MalformedReply(ValueError):
+    pass
+
+@functools.lru_cache(maxsize=64)
+def _json_schema(schema_json):
+    schema = json.loads(schema_json)
+    return {
+        'type': 'object',
+        'properties': {field: {'type': ['string', 'null'], 'description': desc} for field, desc in schema.items()},
+        'required': list(schema),
+        'additionalProperties': False,
+    }
+
+def json_schema(schema):
+    # JSON schema for Ollama's `format`, built from a schema.json style {field: description} dict;
+    # decoding is constrained to it, so the reply is one object with exactly these keys
+    return _json_schema(json.dumps(schema))
+
+_TYPES = {'string': str, 'null': type(None), 'number': (int, float), 'integer': int, 'boolean': bool, 'object': dict, 'array': list}
+
+def validate(obj, json_schema):
+    # the subset of JSON schema json_schema() produces: required keys and per-field types
+    if not isinstance(obj, dict):
+        raise MalformedReply("reply is not a JSON object")
+    missing = [field for field in json_schema.get('required', ()) if field not in obj]
+    if missing:
+        raise MalformedReply("reply lacks " + ', '.join(missing))
+    for field, value in obj.items():
+        spec = json_schema['properties'].get(field)
+        if spec is None:
+            continue
+        types = spec['type'] if isinstance(spec['type'], list) else [spec['type']]
+        if not isinstance(value, tuple(_TYPES[t] for t in types)):
+            raise MalformedReply("{} is not {}".format(field, '/'.join(types)))
+    return obj
+
+class JsonStreamParser:
+    """ incremental parser for one streamed JSON object
+
+    feed() takes reply chunks as they arrive and returns the top-level (key, value) members they
+    completed; text before the opening brace is skipped and `done` is set once it is closed.
+    """
+    def __init__(self):
+        self.result = {}
+        self.done = False
+        self.started = False
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.member = []
+
+    def feed(self, chunk):
+        fields = []
+        for ch in chunk:
+            if self.done:
+                break
+            if not self.started:
+                if ch == '{':
+                    self.started = True
+                    self.depth = 1
+                continue
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == '\\':
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+                self.member.append(ch)
+                continue
+            if ch == '"':
+                self.in_string = True
+            elif ch in '{[':
+                self.depth += 1
+            elif ch in '}]':
+                self.depth -= 1
+            if (self.depth == 1 and ch == ',') or self.depth == 0:
+                member = ''.join(self.member).strip()
+                self.member = []
+                if member:
+                    fields.append(self._parse(member))
+                self.done = self.depth == 0
+                continue
+            self.member.append(ch)
+        return fields
+
+    def _parse(self, member):
+        try:
+            (key, value), = json.loads('{' + member + '}').items()
+        except ValueError:
+            raise MalformedReply("cannot parse " + member[:80])
+        self.result[key] = value
+        return key, value
+
+def packed_json_schema(schema, ids):
+    # array of json_schema(schema) objects, one per id
+    item = json_schema(schema)
+    item = dict(item, properties=dict({'id': {'type': 'string', 'enum': list(ids)}}, **item['properties']),
+                required=['id'] + item['required'])
+    return {'type': 'array', 'items': item, 'minItems': len(ids), 'maxItems': len(ids)}
+
+def validate_packed(reply, json_schema):
+    # {id: fields} of a packed reply; every id exactly once, every item valid
+    if not isinstance(reply, list):
+        raise MalformedReply("reply is not a JSON array")
+    ids = json_schema['items']['properties']['id']['enum']
+    result = {}
+    for item in reply:
+        validate(item, json_schema['items'])
+        if item['id'] not in ids or item['id'] in result:
+            raise MalformedReply("unexpected id {!r}".format(item['id']))
+        result[item['id']] = {field: value for field, value in item.items() if field != 'id'}
+    if len(result) != len(ids):
+        raise MalformedReply("reply lacks " + ', '.join(i for i in ids if i not in result))
+    return result
+
+def _retryable(e):
+    if isinstance(e, MalformedReply):
+        return True
+    if isinstance(e, ollama.ResponseError):
+        return e.status_code in RETRY_STATUS
+    return isinstance(e, (httpx.TransportError, ConnectionError))
+
+class ExtractionClient:
+    """ pooled, concurrency-bounded Ollama chat client for the field-extraction stage
+
+    One keep-alive connection pool is shared by every request; at most `concurrency` requests are
+    in flight, each with connect/read timeouts. Overload, timeout and connection errors are retried
+    with exponential backoff and full jitter. Use it from a single event loop, e.g.
+        async with ExtractionClient(concurrency=8) as client:
+            replies = await client.extract_many(texts)
+    """
+    def __init__(self, host=None, model='llama3:latest', concurrency=4, timeout=120.0, connect_timeout=5.0, retries=3, backoff=0.5,
+                 keep_alive='30m', schema=None):
+        self.model = model
+        self.retries = retries
+        self.backoff = backoff
+        self.keep_alive = keep_alive
+        self.schema = schema
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.client = ollama.AsyncClient(host, timeout=httpx.Timeout(timeout, connect=connect_timeout),
+                                         limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency))
+
+    async def _retrying(self, call):
+        # one request slot per attempt, retried on transient failures
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.semaphore:
+                    with metrics.timed('llm'):
+                        return await call()
+            except Exception as e:
+                if attempt == self.retries or not _retryable(e):
+                    raise
+                metrics.inc('llm_retries')
+                await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    async def chat(self, messages, model=None, **kwargs):
+        # reply content of one chat call
+        async def call():
+            response = await self.client.chat(model=model or self.model, messages=messages, keep_alive=self.keep_alive, **kwargs)
+            return response['message']['content']
+        return await self._retrying(call)
+
+    async def chat_json(self, messages, json_schema, model=None, on_field=None):
+        """ streamed reply constrained to json_schema, parsed while it arrives
+        on_field(key, value) is called for every top-level field as soon as it is complete; the
+        stream is closed once the object is, so trailing tokens are never generated.
+        Return:
+            the validated object
+        """
+        emitted = set()     # a retried request does not report fields twice
+
+        async def call():
+            parser = JsonStreamParser()
+            stream = await self.client.chat(model=model or self.model, messages=messages, keep_alive=self.keep_alive,
+                                            stream=True, format=json_schema)
+            try:
+                async for chunk in stream:
+                    for key, value in parser.feed(chunk['message']['content']):
+                        if on_field is not None and key not in emitted:
+                            emitted.add(key)
+                            on_field(key, value)
+                    if parser.done:
+                        if not chunk.get('done'):
+                            metrics.inc('llm_early_stops')
+                        break
+            finally:
+                await stream.aclose()
+            if not parser.done:
+                raise MalformedReply("stream ended before the JSON object was complete")
+            return validate(parser.result, json_schema)
+        return await self._retrying(call)
+
+    async def extract(self, text, schema=None, model=None, doc_type=None):
+        return await self.chat(build_messages(text, schema or self.schema or load_schema(), doc_type), model)
+
+    async def extract_json(self, text, schema=None, model=None, doc_type=None, on_field=None):
+        # fields of one document as a dict, see chat_json
+        schema = schema or self.schema or load_schema()
+        return await self.chat_json(build_messages(text, schema, doc_type), json_schema(schema), model, on_field)
+
+    async def extract_packed(self, docs, schema=None, model=None, doc_type=None):
+        """ fields of several documents from one request
+        Args:
+            docs (list): (id, text) pairs, ids as str; keep them within the budget, see pack()
+        Return:
+            dict id -> fields, or the exception of a document that failed; when the packed reply
+            does not validate, or the packed request keeps failing, every document is sent on its own
+        """
+        schema = schema or self.schema or load_schema()
+        if len(docs) == 1:
+            return {docs[0][0]: await self.extract_json(docs[0][1], schema, model, doc_type)}
+        reply_schema = packed_json_schema(schema, [doc_id for doc_id, text in docs])
+        try:
+            reply = await self.chat(packed_messages(docs, schema, doc_type), model, format=reply_schema)
+            result = validate_packed(json.loads(reply), reply_schema)
+            metrics.inc('llm_packed_documents', len(docs))
+            return result
+        except Exception as e:
+            # MalformedReply, json.JSONDecodeError, or transient errors past the retries (a packed
+            # request is the one most likely to time out); anything else would fail every document
+            if not isinstance(e, ValueError) and not _retryable(e):
+                raise
+            metrics.inc('llm_pack_fallbacks')
+        fields = await asyncio.gather(*[self.extract_json(text, schema, model, doc_type) for doc_id, text in docs], return_exceptions=True)
+        return {doc_id: f for (doc_id, text), f in zip(docs, fields)}
+
+    async def extract_many(self, texts, schema=None, model=None):
+        # replies in input order; a failed document yields its exception instead of a reply
+        return await asyncio.gather(*[self.extract(text, schema, model) for text in texts], return_exceptions=True)
+
+    async def close(self):
+        await self.client.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+async def extract_fields(text, model='llama3:latest', schema=None, client=None):
+    # returns the raw model reply; pass a shared ExtractionClient, a throwaway one is used otherwise
+    if client is not None:
+        return await client.extract(text, schema, model)
+    async with ExtractionClient(model=model, concurrency=1) as client:
+        return await client.extract(text, schema)
+
+def parse_reply(content):
+    # the JSON object in a model reply, {} when there is none
+    start, end = content.find('{'), content.rfind('}')
+    if start < 0 or end < start:
+        return {}
+    try:
+        reply = json.loads(content[start:end + 1])
+    except ValueError:
+        return {}
+    return reply if isinstance(reply, dict) else {}
+
+def _prepare(text, schema, min_confidence, on_field=None):
+    # rule fields, the document type and the {field: hint} still to ask the LLM for
+    rules = id_rules.extract_rules(text)
+    if 'document_type' not in rules or rules['document_type'][1] < min_confidence:
+        # the classifier's own score: the schema is only narrowed (and document_type only
+        # answered without the LLM) once it clears min_confidence
+        doc_type, score = doc_types.classify(text)
+        if doc_type is not None and score >= doc_types.MIN_CONFIDENCE and score > rules.get('document_type', (None, 0.0))[1]:
+            rules['document_type'] = (doc_type, score)
+    # a rule value below min_confidence is only a guess: it stays None unless the LLM returns it
+    confident = {field: rules[field] for field in schema if field in rules and rules[field][1] >= min_confidence}
+    fields = {field: confident[field][0] if field in confident else None for field in schema}
+    confidence = {field: confident[field][1] if field in confident else None for field in schema}
+
+    doc_type = rules['document_type'][0] if 'document_type' in rules and rules['document_type'][1] >= min_confidence else None
+    wanted = doc_types.schema_for(doc_type, schema)
+    missing = id_rules.missing_fields(rules, wanted, min_confidence)
+    if on_field is not None:
+        for field, (value, score) in confident.items():
+            on_field(field, value)
+    return fields, confidence, doc_type, {field: wanted[field] for field in missing}
+
+def _merge(fields, confidence, reply):
+    for field, value in reply.items():
+        if field in fields and value is not None:
+            fields[field] = value
+            confidence[field] = None
+
+async def extract_document(text, client, schema=None, min_confidence=id_rules.MIN_CONFIDENCE, on_field=None):
+    """ fill the schema fields of one document, rules first and the LLM only for the rest
+    Once the document type is known (id_rules, else doc_types.classify), only the fields that card
+    carries are asked for, with the compact per-type prompt.
+    Args:
+        client (ExtractionClient): used when a field is missing or below min_confidence
+        on_field (callable): on_field(key, value) per field as soon as it is known, rule fields first
+    Return:
+        fields (dict over the schema, None when unknown), confidence (rule confidence, None for LLM values)
+    """
+    fields, confidence, doc_type, request = _prepare(text, schema or client.schema or load_schema(), min_confidence, on_field)
+    if not request:
+        metrics.inc('llm_skipped')
+        return fields, confidence
+
+    def llm_field(field, value):
+        _merge(fields, confidence, {field: value})
+        if on_field is not None:
+            on_field(field, fields.get(field))
+
+    await client.extract_json(text, request, doc_type=doc_type, on_field=llm_field)
+    return fields, confidence
+
+async def extract_documents(texts, client, schema=None, min_confidence=id_rules.MIN_CONFIDENCE, budget=PACK_BUDGET):
+    """ extract_document over a batch, packing several documents into each LLM request
+    Documents are grouped by document type and the fields still missing after the rules, and each
+    group is split into requests of at most `budget` tokens (see pack()), so the shared prompt is
+    paid once per request instead of once per document.
+    Return:
+        list of (fields, confidence) in input order; a document whose LLM request failed yields
+        its exception instead, the rest of the batch is kept
+    """
+    schema = schema or client.schema or load_schema()
+    results, groups = [], {}
+    for i, text in enumerate(texts):
+        fields, confidence, doc_type, request = _prepare(text, schema, min_confidence)
+        results.append((fields, confidence))
+        if not request:
+            metrics.inc('llm_skipped')
+            continue
+        key = (doc_type, tuple(request.items()))
+        groups.setdefault(key, []).append((str(i), text))
+
+    requests = [(dict(request), doc_type, batch) for (doc_type, request), docs in groups.items()
+                for batch in pack(docs, dict(request), doc_type, budget)]
+    replies = await asyncio.gather(*[client.extract_packed(batch, request, doc_type=doc_type) for request, doc_type, batch in requests],
+                                   return_exceptions=True)
+    for (request, doc_type, batch), reply in zip(requests, replies):
+        if isinstance(reply, Exception):
+            reply = {doc_id: reply for doc_id, text in batch}
+        for doc_id, fields in reply.items():
+            if isinstance(fields, Exception):
+                results[int(doc_id)] = fields
+            else:
+                _merge(*results[int(doc_id)], fields)
+    return results
+
+if __name__ == '__main__':
+    import time
+    import argparse
+    parser = argparse.ArgumentParser(description='Field extraction over a file of OCR texts')
+    parser.add_argument('--input', required=True, type=str, help='text file, one document per line')
+    parser.add_argument('--host', default=None, type=str, help='Ollama server (default: $OLLAMA_HOST or localhost:11434)')
+    parser.add_argument('--model', default='llama3:latest', type=str, help='Ollama model used for field extraction')
+    parser.add_argument('--concurrency', default=4, type=int, help='requests in flight')
+    parser.add_argument('--timeout', default=120.0, type=float, help='read timeout per request in seconds')
+    parser.add_argument('--retries', default=3, type=int, help='retries per request on overload, timeout or connection errors')
+    parser.add_argument('--no_rules', default=False, action='store_true', help='send every field to the LLM, skipping id_rules')
+    parser.add_argument('--pack_budget', default=0, type=int, help='pack documents into requests of up to this many tokens (0: one per document)')
+    args = parser.parse_args()
+
+    with open(args.input, 'r') as f:
+        texts = [line.strip() for line in f if line.strip()]
+
+    async def main():
+        async with ExtractionClient(args.host, args.model, args.concurrency, args.timeout, retries=args.retries) as client:
+            if args.no_rules:
+                return await client.extract_many(texts)
+            if args.pack_budget:
+                results = await extract_documents(texts, client, budget=args.pack_budget)
+                return [r if isinstance(r, Exception) else json.dumps(r[0]) for r in results]
+            results = await asyncio.gather(*[extract_document(text, client) for text in texts], return_exceptions=True)
+            return [r if isinstance(r, Exception) else json.dumps(r[0]) for r in results]
+
+    t = time.time()
+    replies = asyncio.run(main())
+    elapsed = time.time() - t
+    for i, reply in enumerate(replies):
+        print(f"{i}: {reply!r}" if isinstance(reply, Exception) else f"{i}: {reply}")
+    failed = sum(isinstance(reply, Exception) for reply in replies)
+    print("{:d} documents ({:d} failed) in {:.1f}s, {:.2f} documents/s".format(len(texts), failed, elapsed, len(texts) / elapsed))
@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# seconds; forward passes on CPU run into the tens of seconds for large canvases
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+PREFIX = 'docid'
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)    # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Registry:
+    """ process-wide stage histograms and counters, safe to update from worker threads """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = Histogram()
+            self.histograms[stage].observe(seconds)
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'stages': {stage: {'count': h.count, 'sum': h.sum} for stage, h in self.histograms.items()},
+                'counters': dict(self.counters),
+            }
+
+    def to_prometheus(self):
+        # text exposition format 0.0.4
+        lines = []
+        with self.lock:
+            name = PREFIX + '_stage_seconds'
+            lines.append('# HELP {} Wall time spent per pipeline stage.'.format(name))
+            lines.append('# TYPE {} histogram'.format(name))
+            for stage in sorted(self.histograms):
+                h = self.histograms[stage]
+                cumulative = 0
+                for bound, n in zip([repr(float(b)) for b in h.buckets] + ['+Inf'], h.counts):
+                    cumulative += n
+                    lines.append('{}_bucket{{stage="{}",le="{}"}} {}'.format(name, stage, bound, cumulative))
+                lines.append('{}_sum{{stage="{}"}} {}'.format(name, stage, repr(h.sum)))
+                lines.append('{}_count{{stage="{}"}} {}'.format(name, stage, h.count))
+            for counter in sorted(self.counters):
+                name = '{}_{}_total'.format(PREFIX, counter)
+                lines.append('# TYPE {} counter'.format(name))
+                lines.append('{} {}'.format(name, self.counters[counter]))
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+# per-thread document trace, see trace()
+_local = threading.local()
+_trace_lock = threading.Lock()
+_trace_file = None
+
+def configure(trace_file=None):
+    # trace_file: JSONL path, one line per document traced with trace(); None disables tracing
+    global _trace_file
+    _trace_file = trace_file
+
+def observe(stage, seconds):
+    REGISTRY.observe(stage, seconds)
+    current = getattr(_local, 'trace', None)
+    if current is not None:
+        current['spans'].append({'stage': stage, 'start': round(time.perf_counter() - seconds - current['t0'], 6),
+                                 'seconds': round(seconds, 6)})
+
+def inc(name, value=1):
+    REGISTRY.inc(name, value)
+    current = getattr(_local, 'trace', None)
+    if current is not None:
+        current['counters'][name] = current['counters'].get(name, 0) + value
+
+@contextmanager
+def timed(stage):
+    # monotonic clock, so wall-clock adjustments never produce negative or inflated durations
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - t)
+
+@contextmanager
+def trace(doc_id, **fields):
+    """ collect every timed()/inc() of this thread under one document
+    and append it to the configured trace file as a JSON line:
+        {"doc": ..., "seconds": ..., "spans": [{"stage", "start", "seconds"}], "counters": {...}, **fields}
+    """
+    if _trace_file is None:
+        yield
+        return
+    parent = getattr(_local, 'trace', None)
+    current = _local.trace = {'t0': time.perf_counter(), 'spans': [], 'counters': {}}
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = repr(e)
+        raise
+    finally:
+        _local.trace = parent
+        record = {'doc': doc_id, 'time': time.time(), 'seconds': round(time.perf_counter() - current['t0'], 6),
+                  'spans': current['spans'], 'counters': current['counters']}
+        record.update(fields)
+        if error is not None:
+            record['error'] = error
+        with _trace_lock, open(_trace_file, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+def to_prometheus():
+    return REGISTRY.to_prometheus()
+
+def write_prometheus(path):
+    # node_exporter textfile-collector style: write aside, then rename into place
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(REGISTRY.to_prometheus())
+    os.replace(tmp, path)
@@ -0,0 +1,93 @@
+import os
+import inspect
+
+import torch
+
+from det_cache import weights_id
+
+BACKENDS = ('torch', 'onnx')
+
+_io = {
+    'craft': {
+        'inputs': ['image'],
+        'outputs': ['y', 'feature'],
+        'dynamic_axes': {'image': {0: 'batch', 2: 'height', 3: 'width'},
+                         'y': {0: 'batch', 1: 'height2', 2: 'width2'},
+                         'feature': {0: 'batch', 2: 'height2', 3: 'width2'}},
+    },
+    'refinenet': {
+        'inputs': ['y', 'feature'],
+        'outputs': ['y_refiner'],
+        'dynamic_axes': {'y': {0: 'batch', 1: 'height2', 2: 'width2'},
+                         'feature': {0: 'batch', 2: 'height2', 3: 'width2'},
+                         'y_refiner': {0: 'batch', 1: 'height2', 2: 'width2'}},
+    },
+}
+
+def onnx_path(weights_path):
+    return weights_path if weights_path.endswith('.onnx') else os.path.splitext(weights_path)[0] + '.onnx'
+
+def export_source(path):
+    # weights_id() of the checkpoint an export was made from, None for exports without one
+    import onnx
+    model = onnx.load(path, load_external_data=False)
+    return {p.key: p.value for p in model.metadata_props}.get('source_sha256')
+
+def export_onnx(model, path, arch='craft', opset_version=17, source=None):
+    # one-time export with dynamic batch/height/width, model is an fp32 CRAFT or RefineNet;
+    # source (weights_id of the checkpoint) is stored in the model metadata
+    model = getattr(model, 'module', model).cpu().eval()   # unwrap DataParallel
+    if arch == 'craft':
+        example = (torch.randn(1, 3, 256, 256),)
+    else:
+        example = (torch.randn(1, 128, 128, 2), torch.randn(1, 32, 128, 128))
+    spec = _io[arch]
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False    # the TorchScript exporter handles dynamic_axes directly
+    with torch.no_grad():
+        torch.onnx.export(model, example, path, input_names=spec['inputs'], output_names=spec['outputs'],
+                          dynamic_axes=spec['dynamic_axes'], opset_version=opset_version, **kwargs)
+    if source is not None:
+        import onnx
+        exported = onnx.load(path)
+        onnx.helper.set_model_props(exported, {'source_sha256': source})
+        onnx.save(exported, path)
+    return path
+
+class OnnxModel:
+    """ onnxruntime session behaving like the torch module it was exported from
+
+    Takes and returns torch tensors, so CRAFT keeps its (y, feature) contract and RefineNet
+    its single output; callers do not need to know which engine they hold.
+    """
+    def __init__(self, path, cuda=False, num_threads=0):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        providers = ['CPUExecutionProvider']
+        if cuda and 'CUDAExecutionProvider' in ort.get_available_providers():
+            providers.insert(0, 'CUDAExecutionProvider')
+        self.session = ort.InferenceSession(path, options, providers=providers)
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def __call__(self, *inputs):
+        feeds = {name: x.detach().cpu().numpy() for name, x in zip(self.input_names, inputs)}
+        outputs = [torch.from_numpy(o) for o in self.session.run(None, feeds)]
+        return tuple(outputs) if len(outputs) > 1 else outputs[0]
+
+    def eval(self):
+        return self
+
+def load_onnx(weights_path, cuda, arch, load_torch, num_threads=0):
+    # reuse <weights>.onnx when it was exported from these weights, otherwise export it (again);
+    # num_threads=0 lets onnxruntime use every core
+    path = onnx_path(weights_path)
+    if path != weights_path:
+        source = weights_id(weights_path)
+        if not os.path.isfile(path) or export_source(path) != source:
+            print('Exporting ' + arch + ' to ONNX (' + path + ')')
+            export_onnx(load_torch(weights_path, False), path, arch, source=source)
+    return OnnxModel(path, cuda, num_threads)
@@ -0,0 +1,81 @@
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+def fold_batchnorm(module):
+    # replace every Conv2d -> BatchNorm2d pair inside a Sequential by one conv with the BN folded in
+    for child in module.modules():
+        if not isinstance(child, nn.Sequential):
+            continue
+        for i in range(len(child) - 1):
+            if isinstance(child[i], nn.Conv2d) and isinstance(child[i + 1], nn.BatchNorm2d):
+                child[i] = fuse_conv_bn_eval(child[i], child[i + 1])
+                child[i + 1] = nn.Identity()
+    return module
+
+def canvas_buckets(canvas_size=1280, aspect_ratios=(1.0, 1.414, 1.586)):
+    # padded canvas shapes imgproc.resize_aspect_ratio produces for images larger than canvas_size
+    # (1.414: A4 scans, 1.586: ID-1 cards), in both orientations
+    def pad32(v):
+        return int(v) + (32 - int(v) % 32) % 32
+    shapes = []
+    for ratio in aspect_ratios:
+        for shape in ((pad32(canvas_size), pad32(canvas_size / ratio)), (pad32(canvas_size / ratio), pad32(canvas_size))):
+            if shape not in shapes:
+                shapes.append(shape)
+    return shapes
+
+def warmup(net, refine_net, shapes, cuda=False, batch_size=1):
+    # run each bucket once so compilation / cudnn autotuning happens before real traffic
+    for h, w in shapes:
+        t = time.time()
+        x = torch.zeros(batch_size, 3, h, w).contiguous(memory_format=torch.channels_last)
+        if cuda:
+            x = x.cuda()
+        with torch.no_grad():
+            y, feature = net(x)
+            if refine_net is not None:
+                refine_net(y, feature)
+        print("warm-up {:d}x{:d} : {:.3f}s".format(h, w, time.time() - t))
+
+def optimize_for_inference(net, refine_net=None, cuda=False, channels_last=True, compile=False, cache_dir=None,
+                           warmup_shapes=None, batch_size=1):
+    """ inference-only rewrite of CRAFT / RefineNet
+    Args:
+        net, refine_net: eval-mode models (DataParallel wrappers are removed)
+        channels_last (bool): store conv weights NHWC; process_images already builds NHWC-strided inputs
+        compile (bool): wrap the models with torch.compile
+        cache_dir (str): persistent inductor cache, so restarted workers reuse compiled kernels
+        warmup_shapes (list): canvas shapes (h, w) to run once before returning, e.g. canvas_buckets()
+    Return:
+        net, refine_net
+    """
+    if cuda:
+        torch.backends.cudnn.benchmark = True   # input shapes are limited to the canvas buckets
+
+    models = []
+    for model in (net, refine_net):
+        if model is None:
+            models.append(None)
+            continue
+        model = fold_batchnorm(getattr(model, 'module', model).eval())
+        if channels_last:
+            model = model.to(memory_format=torch.channels_last)
+        models.append(model)
+
+    if compile:
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.abspath(cache_dir)
+            import torch._inductor.config as inductor_config
+            inductor_config.fx_graph_cache = True
+        models = [torch.compile(model, dynamic=False) if model is not None else None for model in models]
+
+    net, refine_net = models
+    if warmup_shapes:
+        warmup(net, refine_net, warmup_shapes, cuda, batch_size)
+    return net, refine_net
@@ -0,0 +1,224 @@
+import time
+import queue
+import asyncio
+import threading
+
+import imgproc
+import file_utils
+import craft_module
+import llm_extract
+from rec_cache import TEMPLATE_TOLERANCE
+
+_DONE = object()
+
+class Stage:
+    """ one step of the pipeline
+    Args:
+        name (str): stage name used in results and errors
+        fn (callable): payload -> payload; a coroutine function when is_async is set
+        workers (int): worker threads, or concurrent coroutines for async stages
+        is_async (bool): run fn on a dedicated asyncio loop (for I/O bound calls such as the LLM)
+        close (callable): called once the stage has handled its last item, e.g. to release a
+            client; a coroutine function for async stages, run on the stage's loop
+    """
+    def __init__(self, name, fn, workers=1, is_async=False, close=None):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.is_async = is_async
+        self.close = close
+
+class Pipeline:
+    """ runs documents through stages connected by bounded queues
+
+    Every stage pulls (doc_id, payload, error) from its input queue and puts the result on
+    the next one; a full queue blocks the upstream stage, so a slow LLM stage throttles
+    decoding instead of letting decoded images pile up in memory. Once an item fails,
+    later stages pass it through untouched.
+    """
+    def __init__(self, stages, queue_size=8):
+        self.stages = stages
+        self.queue_size = queue_size
+
+    def run(self, items):
+        """ yields (doc_id, result, error) in completion order; items is an iterable of (doc_id, payload) """
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0]), daemon=True)]
+        for stage, q_in, q_out in zip(self.stages, queues[:-1], queues[1:]):
+            if stage.is_async:
+                threads.append(threading.Thread(target=self._run_async, args=(stage, q_in, q_out), daemon=True))
+            else:
+                remaining = [stage.workers]
+                lock = threading.Lock()
+                for _ in range(stage.workers):
+                    threads.append(threading.Thread(target=self._run_worker, args=(stage, q_in, q_out, remaining, lock), daemon=True))
+        for t in threads:
+            t.start()
+
+        while True:
+            item = queues[-1].get()
+            if item is _DONE:
+                break
+            yield item
+
+        for t in threads:
+            t.join()
+
+    @staticmethod
+    def _feed(items, q_out):
+        for doc_id, payload in items:
+            q_out.put((doc_id, payload, None))
+        q_out.put(_DONE)
+
+    @staticmethod
+    def _apply(stage, item):
+        doc_id, payload, error = item
+        if error is not None:
+            return item
+        try:
+            return doc_id, stage.fn(payload), None
+        except Exception as e:
+            return doc_id, None, (stage.name, e)
+
+    def _run_worker(self, stage, q_in, q_out, remaining, lock):
+        while True:
+            item = q_in.get()
+            if item is _DONE:
+                q_in.put(_DONE)     # let sibling workers see it too
+                break
+            q_out.put(self._apply(stage, item))
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            try:
+                if stage.close is not None:
+                    stage.close()
+            finally:
+                q_out.put(_DONE)
+
+    def _run_async(self, stage, q_in, q_out):
+        asyncio.run(self._async_loop(stage, q_in, q_out))
+
+    @staticmethod
+    async def _async_loop(stage, q_in, q_out):
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(stage.workers)
+        pending = set()
+
+        async def handle(item):
+            doc_id, payload, error = item
+            try:
+                if error is None:
+                    try:
+                        item = doc_id, await stage.fn(payload), None
+                    except Exception as e:
+                        item = doc_id, None, (stage.name, e)
+                await loop.run_in_executor(None, q_out.put, item)
+            finally:
+                semaphore.release()
+
+        try:
+            while True:
+                await semaphore.acquire()
+                item = await loop.run_in_executor(None, q_in.get)
+                if item is _DONE:
+                    semaphore.release()
+                    break
+                task = asyncio.create_task(handle(item))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+
+            if pending:
+                await asyncio.gather(*pending)
+        finally:
+            try:
+                if stage.close is not None:
+                    await stage.close()
+            finally:
+                q_out.put(_DONE)
+
+def build_document_pipeline(trained_model='weights/craft_mlt_25k.pth', cuda=True, refiner_model=None, llm_model='llama3:latest', llm_host=None,
+                            decode_workers=2, detect_workers=1, crop_workers=1, recognize_workers=1, llm_concurrency=4, queue_size=8,
+                            cache=None, rec_cache=None):
+    # decode -> detect -> crop -> recognize -> extract, payloads flow as plain values
+    def decode(image_path):
+        return imgproc.loadImage(image_path)
+
+    def detect(image):
+        bboxes, polys, score_text = craft_module.detect_image(image, trained_model, cuda, refiner_model, cache=cache)
+        return image, polys
+
+    def crop(detection):
+        image, polys = detection
+        return craft_module.crop_segments(image, polys)
+
+    def recognize(segments):
+        import trocr     # loads the TrOCR weights on first use
+        return trocr.ocr_segments(segments, cache=rec_cache)
+
+    clients = []    # one pooled client, created inside the extract stage's event loop
+
+    async def extract(recognized):
+        if not clients:
+            clients.append(llm_extract.ExtractionClient(llm_host, llm_model, concurrency=llm_concurrency))
+        text = ' '.join(text for text, box in recognized)
+        fields, confidence = await llm_extract.extract_document(text, clients[0])
+        return fields
+
+    async def close_extract():
+        # the client's connection pool belongs to the stage's event loop, close it there
+        if clients:
+            await clients.pop().close()
+
+    craft_module.get_models(trained_model, cuda, refiner_model)
+    return Pipeline([
+        Stage('decode', decode, decode_workers),
+        Stage('detect', detect, detect_workers),
+        Stage('crop', crop, crop_workers),
+        Stage('recognize', recognize, recognize_workers),
+        Stage('extract', extract, llm_concurrency, is_async=True, close=close_extract),
+    ], queue_size=queue_size)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Staged document pipeline')
+    parser.add_argument('--trained_model', default='weights/craft_mlt_25k.pth', type=str, help='pretrained model')
+    parser.add_argument('--test_folder', default='/data/', type=str, help='folder path to input images')
+    parser.add_argument('--cuda', default=False, action='store_true', help='Use cuda for inference')
+    parser.add_argument('--llm_model', default='llama3:latest', type=str, help='Ollama model used for field extraction')
+    parser.add_argument('--llm_host', default=None, type=str, help='Ollama server (default: $OLLAMA_HOST or localhost:11434)')
+    parser.add_argument('--detect_workers', default=1, type=int, help='concurrent detector threads')
+    parser.add_argument('--recognize_workers', default=1, type=int, help='concurrent recognizer threads')
+    parser.add_argument('--llm_concurrency', default=4, type=int, help='LLM requests in flight')
+    parser.add_argument('--queue_size', default=8, type=int, help='capacity of the queue between two stages')
+    parser.add_argument('--cache', default=None, type=str, help='SQLite detection cache, e.g. weights/detections.sqlite')
+    parser.add_argument('--rec_cache', default=None, type=str, help='recognition cache file, e.g. weights/recognitions.jsonl')
+    parser.add_argument('--rec_cache_tolerance', default=TEMPLATE_TOLERANCE, type=float,
+                        help='share of hash bits a rescanned template crop may differ by (0: exact matches only)')
+    args = parser.parse_args()
+
+    cache = None
+    if args.cache:
+        from det_cache import DetectionCache
+        cache = DetectionCache(args.cache)
+    rec_cache = None
+    if args.rec_cache:
+        from rec_cache import RecognitionCache
+        rec_cache = RecognitionCache(args.rec_cache, tolerance=args.rec_cache_tolerance)
+
+    image_list, _, _ = file_utils.get_files(args.test_folder)
+    pipeline = build_document_pipeline(args.trained_model, args.cuda, llm_model=args.llm_model, llm_host=args.llm_host, detect_workers=args.detect_workers,
+                                       recognize_workers=args.recognize_workers, llm_concurrency=args.llm_concurrency,
+                                       queue_size=args.queue_size, cache=cache, rec_cache=rec_cache)
+
+    t = time.time()
+    for image_path, result, error in pipeline.run((path, path) for path in image_list):
+        if error is not None:
+            print(f"{image_path}: failed in {error[0]}: {error[1]}")
+        else:
+            print(f"{image_path}: {result}")
+    print("elapsed time : {}s".format(time.time() - t))
+    if rec_cache is not None:
+        rec_cache.close()
+        print("recognition cache : {entries} entries, {hit_rate:.0%} hits".format(**rec_cache.stats()))
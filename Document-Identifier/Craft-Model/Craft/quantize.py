@@ -0,0 +1,126 @@
+import os
+import time
+
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+QUANT_BACKEND = 'x86'
+
+def _new_model(arch):
+    if arch == 'craft':
+        from craft import CRAFT
+        return CRAFT().eval()
+    from refinenet import RefineNet
+    return RefineNet().eval()
+
+def _example_inputs(arch):
+    if arch == 'craft':
+        return (torch.randn(1, 3, 256, 256),)
+    return (torch.randn(1, 128, 128, 2), torch.randn(1, 32, 128, 128))
+
+def prepare_model(model, arch):
+    # insert observers; run calibration data through the result, then call convert_fx
+    torch.backends.quantized.engine = QUANT_BACKEND
+    return prepare_fx(model.eval(), get_default_qconfig_mapping(QUANT_BACKEND), _example_inputs(arch))
+
+def save_quantized(model, arch, path):
+    torch.save({'quantized': True, 'arch': arch, 'backend': QUANT_BACKEND, 'state_dict': model.state_dict()}, path)
+
+def load_quantized(checkpoint, arch):
+    # the graph is rebuilt from a fresh model, the checkpoint supplies weights and qparams
+    if checkpoint['arch'] != arch:
+        raise ValueError(f"checkpoint holds a quantized {checkpoint['arch']}, expected {arch}")
+    model = convert_fx(prepare_model(_new_model(arch), arch))
+    model.load_state_dict(checkpoint['state_dict'])
+    return model.eval()
+
+def quantize_models(net, refine_net, calib_images, canvas_size=1280, mag_ratio=1.5):
+    """ static INT8 quantization of CRAFT (and optionally RefineNet)
+    Args:
+        net (CRAFT): fp32 model on CPU
+        refine_net (RefineNet): fp32 refiner on CPU, or None
+        calib_images (list): RGB images run through the models to collect activation ranges
+    Return:
+        quantized net, quantized refine_net (None when refine_net is None)
+    """
+    from craft_module import forward_images
+    prepared_net = prepare_model(net, 'craft')
+    prepared_refiner = prepare_model(refine_net, 'refinenet') if refine_net is not None else None
+    for _ in forward_images(prepared_net, calib_images, False, prepared_refiner, canvas_size, mag_ratio, batch_size=1):
+        pass
+    q_refiner = convert_fx(prepared_refiner) if prepared_refiner is not None else None
+    return convert_fx(prepared_net), q_refiner
+
+def compare_models(ref, test, images, text_threshold=0.7, link_threshold=0.4, low_text=0.4, poly=False,
+                   canvas_size=1280, mag_ratio=1.5, iou_threshold=0.5):
+    """ detection agreement of `test` against `ref`, both (net, refine_net) pairs on CPU
+
+    Boxes from craft_utils.getDetBoxes are matched one-to-one by IoU; recall is the share of
+    reference boxes found by the test model and precision the share of test boxes that match one.
+    """
+    import craft_utils
+    from craft_module import process_images
+    n_ref = n_test = n_match = 0
+    times = {'ref': 0.0, 'test': 0.0}
+    for image in images:
+        boxes = {}
+        for name, (net, refine_net) in (('ref', ref), ('test', test)):
+            t = time.time()
+            boxes[name], _, _ = process_images(net, [image], text_threshold, link_threshold, low_text, False, poly, refine_net,
+                                               canvas_size=canvas_size, mag_ratio=mag_ratio)[0]
+            times[name] += time.time() - t
+        n_ref += len(boxes['ref'])
+        n_test += len(boxes['test'])
+        n_match += craft_utils.matchBoxes(boxes['ref'], boxes['test'], iou_threshold)
+    return {
+        'images': len(images),
+        'ref_boxes': n_ref,
+        'test_boxes': n_test,
+        'matched': n_match,
+        'recall': n_match / n_ref if n_ref else 1.0,
+        'precision': n_match / n_test if n_test else 1.0,
+        'ref_time': times['ref'],
+        'test_time': times['test'],
+    }
+
+if __name__ == '__main__':
+    import json
+    import argparse
+    import imgproc
+    import file_utils
+    from craft_module import load_model, load_refiner
+    parser = argparse.ArgumentParser(description='INT8 quantization of CRAFT / RefineNet')
+    parser.add_argument('--trained_model', default='weights/craft_mlt_25k.pth', type=str, help='fp32 model to quantize')
+    parser.add_argument('--output', default=None, type=str, help='quantized checkpoint path (default: <trained_model>.int8.pth)')
+    parser.add_argument('--refiner_model', default=None, type=str, help='fp32 refiner to quantize as well')
+    parser.add_argument('--refiner_output', default=None, type=str, help='quantized refiner path (default: <refiner_model>.int8.pth)')
+    parser.add_argument('--calib_folder', required=True, type=str, help='folder of sample images used for calibration')
+    parser.add_argument('--num_calib', default=32, type=int, help='number of calibration images')
+    parser.add_argument('--eval_folder', default=None, type=str, help='folder used for the fp32 vs int8 accuracy report')
+    parser.add_argument('--canvas_size', default=1280, type=int, help='image size for inference')
+    parser.add_argument('--mag_ratio', default=1.5, type=float, help='image magnification ratio')
+    args = parser.parse_args()
+
+    net = load_model(args.trained_model, False)
+    refine_net = load_refiner(args.refiner_model, False) if args.refiner_model else None
+
+    calib_list, _, _ = file_utils.get_files(args.calib_folder)
+    calib_images = [imgproc.loadImage(path) for path in calib_list[:args.num_calib]]
+    print("Calibrating on {:d} images".format(len(calib_images)))
+    q_net, q_refiner = quantize_models(net, refine_net, calib_images, args.canvas_size, args.mag_ratio)
+
+    output = args.output or os.path.splitext(args.trained_model)[0] + '.int8.pth'
+    save_quantized(q_net, 'craft', output)
+    print("Saved " + output)
+    if q_refiner is not None:
+        refiner_output = args.refiner_output or os.path.splitext(args.refiner_model)[0] + '.int8.pth'
+        save_quantized(q_refiner, 'refinenet', refiner_output)
+        print("Saved " + refiner_output)
+
+    if args.eval_folder:
+        eval_list, _, _ = file_utils.get_files(args.eval_folder)
+        eval_images = [imgproc.loadImage(path) for path in eval_list]
+        report = compare_models((net, refine_net), (q_net, q_refiner), eval_images, poly=refine_net is not None,
+                                canvas_size=args.canvas_size, mag_ratio=args.mag_ratio)
+        print(json.dumps(report, indent=4))
@@ -0,0 +1,152 @@
+import os
+import re
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image, ImageOps
+
+import metrics
+
+# every crop is hashed on the same grid of cells, whatever its size
+HASH_HEIGHT = 8
+HASH_WIDTH = 48
+# aspect ratio buckets, in steps of log(aspect); a lookup also searches the neighbouring buckets,
+# so a crop rescanned ~5% wider or narrower (or a pixel taller from blur) still finds its template
+ASPECT_STEP = 0.1
+
+# share of differing hash bits a template lookup may accept. Rescans of one string (another scan,
+# noise, JPEG, +-5% width) stay below ~16%, different words are 35% and more apart. Numbers
+# differing in one digit are much closer, which is why only TEMPLATES are ever matched this way
+TEMPLATE_TOLERANCE = 0.2
+
+# printed card text that carries no personal data, the only entries a near match may return
+TEMPLATES = ('GOVERNMENT OF INDIA', 'GOVT OF INDIA', 'INCOME TAX DEPARTMENT', 'PERMANENT ACCOUNT NUMBER', 'PERMANENT ACCOUNT NUMBER CARD',
+             'UNIQUE IDENTIFICATION AUTHORITY OF INDIA', 'MERA AADHAAR MERI PEHCHAN', 'REPUBLIC OF INDIA', 'DRIVING LICENCE',
+             'DOB', 'DATE OF BIRTH', 'NAME', 'FATHERS NAME', 'SIGNATURE', 'ADDRESS', 'GENDER', 'MALE', 'FEMALE')
+_NON_LETTERS = re.compile(r'[^A-Z ]')
+
+def normalize_template(text):
+    # "Father's Name:" -> "FATHERS NAME"; None for text with digits, which is never a template
+    if any(ch.isdigit() for ch in text):
+        return None
+    return ' '.join(_NON_LETTERS.sub('', text.upper()).split())
+
+def crop_hash(crop, model='trocr'):
+    """ perceptual key of one text crop for one recognizer
+    The crop is reduced to grayscale and stretched to full contrast, trimmed to its ink (so the
+    detector's margin does not matter), resized to the fixed HASH_WIDTH x HASH_HEIGHT grid and
+    thresholded at its mean to ink / paper cells. The aspect ratio of the ink is kept as a bucket.
+    Args:
+        crop (PIL.Image or array): RGB or grayscale crop
+        model (str): recognizer id, so another model never sees these entries
+    Return:
+        "<model digest>:<aspect bucket>:<bits as hex>"
+    """
+    img = crop if isinstance(crop, Image.Image) else Image.fromarray(np.asarray(crop))
+    img = ImageOps.autocontrast(img.convert('L'), cutoff=1)
+    pixels = np.asarray(img)
+    ys, xs = np.nonzero(pixels < (int(pixels.min()) + int(pixels.max())) / 2)
+    if len(xs):
+        img = img.crop((xs.min(), ys.min(), xs.max() + 1, ys.max() + 1))
+    w, h = img.size
+    bucket = round(np.log(max(w, 1) / max(h, 1)) / ASPECT_STEP)
+    cells = np.asarray(img.resize((HASH_WIDTH, HASH_HEIGHT), Image.BOX), dtype=np.float32)
+    return '{}:{}:{}'.format(hashlib.sha1(model.encode()).hexdigest()[:12], bucket, np.packbits(cells < cells.mean()).tobytes().hex())
+
+def _split(key):
+    bucket, bits = key.rsplit(':', 1)
+    return bucket, np.frombuffer(bytes.fromhex(bits), dtype=np.uint8)
+
+def _neighbours(bucket):
+    model, aspect = bucket.rsplit(':', 1)
+    return ['{}:{}'.format(model, int(aspect) + d) for d in (0, -1, 1)]
+
+class RecognitionCache:
+    """ recognized text per crop_hash(), least recently used entries evicted past max_entries
+
+    A lookup without an exact match may take the closest entry of the same model and a neighbouring
+    aspect bucket within `tolerance` (share of differing bits), but only an entry whose text is one
+    of `templates`: printed card text hits across documents, recognized personal data (names,
+    numbers, dates) is only ever returned for an exact match. tolerance=0 makes every lookup exact.
+    In memory and shared by threads; with a path the entries are read at start and written back by
+    save(), so template text stays cached across restarts.
+    """
+    def __init__(self, path=None, max_entries=20000, tolerance=TEMPLATE_TOLERANCE, templates=TEMPLATES):
+        self.path = path
+        self.max_entries = max_entries
+        self.tolerance = tolerance
+        self.templates = {normalize_template(t) for t in templates}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.buckets = {}       # model:aspect bucket -> {key: packed bits}, template entries only
+        if path and os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    self.put(*json.loads(line))
+
+    def _nearest(self, key):
+        bucket, bits = _split(key)
+        candidates = {}
+        for neighbour in _neighbours(bucket):
+            candidates.update(self.buckets.get(neighbour, {}))
+        if not candidates:
+            return None
+        keys = list(candidates)
+        distances = np.unpackbits(np.stack([candidates[k] for k in keys]) ^ bits, axis=1).sum(axis=1)
+        best = int(np.argmin(distances))
+        return keys[best] if distances[best] <= self.tolerance * bits.size * 8 else None
+
+    def get(self, key):
+        # text or None
+        with self.lock:
+            if key not in self.entries and self.tolerance > 0:
+                key = self._nearest(key)
+            text = self.entries.get(key) if key is not None else None
+            if text is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+        metrics.inc('rec_cache_misses' if text is None else 'rec_cache_hits')
+        return text
+
+    def put(self, key, text):
+        with self.lock:
+            self.entries[key] = text
+            self.entries.move_to_end(key)
+            if normalize_template(text) in self.templates:
+                bucket, bits = _split(key)
+                self.buckets.setdefault(bucket, {})[key] = bits
+            while len(self.entries) > self.max_entries:
+                old, _ = self.entries.popitem(last=False)
+                bucket = old.rsplit(':', 1)[0]
+                if old in self.buckets.get(bucket, ()):
+                    del self.buckets[bucket][old]
+                    if not self.buckets[bucket]:
+                        del self.buckets[bucket]
+
+    def save(self):
+        # least recently used first, so loading replays the recency order
+        if not self.path:
+            return
+        with self.lock:
+            items = list(self.entries.items())
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            for item in items:
+                f.write(json.dumps(item, ensure_ascii=False) + '\n')
+        os.replace(tmp, self.path)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    def close(self):
+        self.save()
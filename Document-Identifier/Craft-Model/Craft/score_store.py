@@ -0,0 +1,110 @@
+import os
+import json
+
+import numpy as np
+
+DTYPES = ('float16', 'uint8')
+
+class ScoreStore:
+    """ region / affinity score maps of a dataset, kept for re-running post-processing only
+
+    Layout of the folder:
+        meta.json     dtype and the settings the maps were produced with
+        index.jsonl   one entry per image: name, offset, height, width, ratio_w, ratio_h
+        maps.bin      [score_text, score_link] per image, back to back, memory-mapped for reading
+
+    uint8 maps are scores * 255 rounded (half the size of float16, thresholds resolve to 1/255).
+    """
+    def __init__(self, folder, mode='r', dtype='float16', meta=None):
+        self.folder = folder
+        self.data_file = os.path.join(folder, 'maps.bin')
+        self.index_file = os.path.join(folder, 'index.jsonl')
+        meta_file = os.path.join(folder, 'meta.json')
+        if mode == 'w':
+            if dtype not in DTYPES:
+                raise ValueError("dtype must be one of " + ', '.join(DTYPES))
+            os.makedirs(folder, exist_ok=True)
+            self.meta = dict(meta or {}, dtype=dtype)
+            with open(meta_file, 'w') as f:
+                json.dump(self.meta, f, indent=4)
+            open(self.data_file, 'wb').close()
+            open(self.index_file, 'w').close()
+        else:
+            with open(meta_file, 'r') as f:
+                self.meta = json.load(f)
+        self.dtype = np.dtype(self.meta['dtype'])
+        self.entries = {}
+        with open(self.index_file, 'r') as f:
+            for line in f:
+                entry = json.loads(line)
+                self.entries[entry['name']] = entry
+        self._map = None
+
+    def add(self, name, score_text, score_link, ratio_w, ratio_h):
+        maps = np.stack([score_text, score_link])
+        if self.dtype == np.uint8:
+            maps = np.round(np.clip(maps, 0, 1) * 255)
+        maps = np.ascontiguousarray(maps.astype(self.dtype))
+        with open(self.data_file, 'ab') as f:
+            offset = f.tell()
+            f.write(maps.tobytes())
+        entry = {'name': name, 'offset': offset, 'height': maps.shape[1], 'width': maps.shape[2],
+                 'ratio_w': float(ratio_w), 'ratio_h': float(ratio_h)}
+        with open(self.index_file, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+        self.entries[name] = entry
+        self._map = None
+
+    def names(self):
+        return list(self.entries)
+
+    def load(self, name):
+        # (score_text, score_link, ratio_w, ratio_h), maps as float32 in [0, 1]
+        if self._map is None:
+            self._map = np.memmap(self.data_file, dtype=np.uint8, mode='r')
+        e = self.entries[name]
+        size = 2 * e['height'] * e['width'] * self.dtype.itemsize
+        maps = self._map[e['offset']:e['offset'] + size].view(self.dtype).reshape(2, e['height'], e['width'])
+        maps = maps.astype(np.float32)
+        if self.dtype == np.uint8:
+            maps /= 255
+        return maps[0], maps[1], e['ratio_w'], e['ratio_h']
+
+def build_store(net, image_list, folder, cuda=False, refine_net=None, canvas_size=1280, mag_ratio=1.5, batch_size=8, dtype='float16',
+                meta=None):
+    # one forward pass per image; everything after it can be replayed from the store
+    import imgproc
+    from craft_module import forward_images
+    store = ScoreStore(folder, 'w', dtype, dict(meta or {}, canvas_size=canvas_size, mag_ratio=mag_ratio, refine=refine_net is not None))
+    for k in range(0, len(image_list), batch_size):
+        paths = image_list[k:k + batch_size]
+        images = [imgproc.loadImage(path) for path in paths]
+        for idx, score_text, score_link, ratio in forward_images(net, images, cuda, refine_net, canvas_size, mag_ratio, batch_size):
+            store.add(paths[idx], score_text, score_link, ratio, ratio)
+        print("Stored {:d}/{:d}".format(k + len(paths), len(image_list)), end='\r')
+    print()
+    return store
+
+if __name__ == '__main__':
+    import argparse
+    import file_utils
+    from craft_module import load_model, load_refiner
+    parser = argparse.ArgumentParser(description='Store CRAFT score maps for threshold_sweep.py')
+    parser.add_argument('--trained_model', default='weights/craft_mlt_25k.pth', type=str, help='pretrained model')
+    parser.add_argument('--refiner_model', default=None, type=str, help='pretrained refiner model (stores the refined link map)')
+    parser.add_argument('--backend', default='torch', choices=['torch', 'onnx'], help='inference engine for the detector')
+    parser.add_argument('--cuda', default=False, action='store_true', help='use cuda for inference')
+    parser.add_argument('--test_folder', required=True, type=str, help='folder path to input images')
+    parser.add_argument('--output', required=True, type=str, help='store folder')
+    parser.add_argument('--dtype', default='float16', choices=DTYPES, help='storage type of the score maps')
+    parser.add_argument('--canvas_size', default=1280, type=int, help='image size for inference')
+    parser.add_argument('--mag_ratio', default=1.5, type=float, help='image magnification ratio')
+    parser.add_argument('--batch_size', default=8, type=int, help='number of images stacked into one forward pass')
+    args = parser.parse_args()
+
+    net = load_model(args.trained_model, args.cuda, args.backend)
+    refine_net = load_refiner(args.refiner_model, args.cuda, args.backend) if args.refiner_model else None
+    image_list, _, _ = file_utils.get_files(args.test_folder)
+    store = build_store(net, image_list, args.output, args.cuda, refine_net, args.canvas_size, args.mag_ratio, args.batch_size, args.dtype,
+                        meta={'trained_model': args.trained_model, 'refiner_model': args.refiner_model})
+    print("{:d} images, {:.1f} MB in {:s}".format(len(store.entries), os.path.getsize(store.data_file) / 2**20, args.output))
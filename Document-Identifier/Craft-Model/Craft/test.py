@@ -16,11 +16,13 @@ import numpy as np
 import craft_utils
 import imgproc
 import file_utils
+import metrics
 import json
 import gdown
 import zipfile
 
 from craft import CRAFT
+from craft_module import load_model, load_refiner, process_images, process_image_tiled, process_image_adaptive, count_page
 
 from collections import OrderedDict
 
@@ -60,6 +62,27 @@ parser.add_argument('--test_folder', default='/data/', type=str, help='folder pa
 parser.add_argument('--image_path', default=None, type=str, help='path to a single input image')
 parser.add_argument('--refine', default=False, action='store_true', help='enable link refiner')
 parser.add_argument('--refiner_model', default='weights/craft_refiner_CTW1500.pth', type=str, help='pretrained refiner model')
+parser.add_argument('--backend', default='torch', choices=['torch', 'onnx'], help='inference engine for the detector (onnx exports <weights>.onnx on first use)')
+parser.add_argument('--optimize', default=False, action='store_true', help='fold BatchNorm into convs and use channels_last weights')
+parser.add_argument('--compile', default=False, action='store_true', help='torch.compile the optimized models (implies --optimize)')
+parser.add_argument('--compile_cache', default='weights/inductor_cache', type=str, help='on-disk cache for compiled kernels')
+parser.add_argument('--warmup', default=False, action='store_true', help='run every canvas-size bucket once before the first image')
+parser.add_argument('--output_policy', default='debug', choices=file_utils.OUTPUT_POLICIES,
+                    help='none: no files, coords: res_<name>.txt only, debug: also the annotated image and score heatmap')
+parser.add_argument('--fast_decode', default=False, action='store_true', help='decode JPEGs at reduced size when the canvas is smaller than the image')
+parser.add_argument('--cache', default=None, type=str, help='SQLite detection cache; unchanged images are not detected again')
+parser.add_argument('--cache_size', default=100000, type=int, help='detection cache entries kept (least recently used are evicted)')
+parser.add_argument('--metrics_file', default=None, type=str, help='write per-stage latency histograms and counters here (Prometheus text format)')
+parser.add_argument('--trace_file', default=None, type=str, help='append one JSON line of stage timings per document to this file')
+parser.add_argument('--batch_size', default=1, type=int, help='number of images stacked into one forward pass')
+parser.add_argument('--tile_size', default=0, type=int, help='detect on overlapping tiles of this size at native scale (0: resize to canvas_size)')
+parser.add_argument('--tile_overlap', default=256, type=int, help='overlap between neighbouring tiles')
+parser.add_argument('--adaptive', default=False, action='store_true', help='pick the canvas per image from a low resolution probe pass')
+parser.add_argument('--probe_size', default=512, type=int, help='canvas size of the adaptive probe pass')
+parser.add_argument('--min_char_height', default=16, type=int, help='adaptive mode keeps characters at least this many canvas pixels tall')
+parser.add_argument('--workers', default=1, type=int, help='number of worker processes, each with its own model')
+parser.add_argument('--threads_per_worker', default=None, type=int, help='torch/cv2 threads per worker process (default: cores / workers)')
+parser.add_argument('--checkpoint', default=None, type=str, help='manifest of finished images; a rerun with the same model and settings resumes from it')
 
 args = parser.parse_args()
 
@@ -85,103 +108,135 @@ result_folder = './result/'
 if not os.path.isdir(result_folder):
     os.mkdir(result_folder)
 
-def test_net(net, image, text_threshold, link_threshold, low_text, cuda, poly, refine_net=None):
+def decode_size():
+    # largest long side the detector will use; None when the image is needed at full resolution
+    if not args.fast_decode or args.tile_size:
+        return None
+    if args.adaptive:
+        return args.canvas_size
+    return args.canvas_size / args.mag_ratio
+
+def detect_batch(net, refine_net, images, render):
+    # (bboxes, polys, score_text) per image with the detection mode selected on the command line
+    if args.tile_size:
+        return [process_image_tiled(net, image, args.text_threshold, args.link_threshold, args.low_text, args.cuda, args.poly, refine_net,
+                                    tile_size=args.tile_size, overlap=args.tile_overlap, batch_size=max(args.batch_size, 1))
+                for image in images]
+    if args.adaptive:
+        return [process_image_adaptive(net, image, args.text_threshold, args.link_threshold, args.low_text, args.cuda, args.poly, refine_net,
+                                       probe_size=args.probe_size, min_char_height=args.min_char_height, canvas_size=args.canvas_size,
+                                       render=render)
+                for image in images]
     t0 = time.time()
+    results = process_images(net, images, args.text_threshold, args.link_threshold, args.low_text, args.cuda, args.poly, refine_net,
+                             canvas_size=args.canvas_size, mag_ratio=args.mag_ratio, batch_size=max(args.batch_size, 1), render=render)
+    if args.show_time : print("\ndetection time ({:d} images) : {:.3f}".format(len(images), time.time() - t0))
+    return results
 
-    # resize
-    img_resized, target_ratio, size_heatmap = imgproc.resize_aspect_ratio(image, args.canvas_size, interpolation=cv2.INTER_LINEAR, mag_ratio=args.mag_ratio)
-    ratio_h = ratio_w = 1 / target_ratio
-
-    # preprocessing
-    x = imgproc.normalizeMeanVariance(img_resized)
-    x = torch.from_numpy(x).permute(2, 0, 1)    # [h, w, c] to [c, h, w]
-    x = Variable(x.unsqueeze(0))                # [c, h, w] to [b, c, h, w]
-    if cuda:
-        x = x.cuda()
-
-    # forward pass
-    with torch.no_grad():
-        y, feature = net(x)
-
-    # make score and link map
-    score_text = y[0,:,:,0].cpu().data.numpy()
-    score_link = y[0,:,:,1].cpu().data.numpy()
-
-    # refine link
-    if refine_net is not None:
-        with torch.no_grad():
-            y_refiner = refine_net(y, feature)
-        score_link = y_refiner[0,:,:,0].cpu().data.numpy()
-
-    t0 = time.time() - t0
-    t1 = time.time()
-
-    # Post-processing
-    boxes, polys = craft_utils.getDetBoxes(score_text, score_link, text_threshold, link_threshold, low_text, poly)
-
-    # coordinate adjustment
-    boxes = craft_utils.adjustResultCoordinates(boxes, ratio_w, ratio_h)
-    polys = craft_utils.adjustResultCoordinates(polys, ratio_w, ratio_h)
-    for k in range(len(polys)):
-        if polys[k] is None: polys[k] = boxes[k]
-
-    t1 = time.time() - t1
-
-    # render results (optional)
-    render_img = score_text.copy()
-    render_img = np.hstack((render_img, score_link))
-    ret_score_text = imgproc.cvt2HeatmapImg(render_img)
-
-    if args.show_time : print("\ninfer/postproc time : {:.3f}/{:.3f}".format(t0, t1))
+def test_net(net, image, text_threshold, link_threshold, low_text, cuda, poly, refine_net=None):
+    # single image through the same resize/forward/postprocess path as the batches
+    return process_images(net, [image], text_threshold, link_threshold, low_text, cuda, poly, refine_net,
+                          canvas_size=args.canvas_size, mag_ratio=args.mag_ratio, batch_size=1,
+                          render=args.output_policy == 'debug')[0]
+
+def detection_params():
+    # every setting that changes the boxes, part of the detection cache key
+    params = {name: getattr(args, name) for name in ('text_threshold', 'link_threshold', 'low_text', 'canvas_size', 'mag_ratio',
+              'poly', 'tile_size', 'tile_overlap', 'adaptive', 'probe_size', 'min_char_height', 'fast_decode')}
+    params['poly'] = args.poly or args.refine
+    return params
 
-    return boxes, polys, ret_score_text
 if __name__ == '__main__':
-    # load net
-    net = CRAFT()     # initialize
+    if args.workers > 1 or args.checkpoint:
+        # folder_runner workers run the plain single-image path
+        unsupported = [flag for flag, used in (('--tile_size', args.tile_size), ('--adaptive', args.adaptive), ('--fast_decode', args.fast_decode),
+                       ('--batch_size', args.batch_size > 1), ('--optimize', args.optimize), ('--compile', args.compile),
+                       ('--warmup', args.warmup), ('--metrics_file', args.metrics_file), ('--trace_file', args.trace_file)) if used]
+        if unsupported:
+            parser.error(', '.join(unsupported) + ' cannot be combined with --workers/--checkpoint')
+        from folder_runner import run_folder
+        threads_per_worker = args.threads_per_worker or max(1, os.cpu_count() // args.workers)
+        run_folder(image_list, args.trained_model, result_folder, args.checkpoint,
+                   workers=args.workers, threads_per_worker=threads_per_worker, cuda=args.cuda,
+                   refiner_model=args.refiner_model if args.refine else None, text_threshold=args.text_threshold,
+                   link_threshold=args.link_threshold, low_text=args.low_text, poly=args.poly,
+                   canvas_size=args.canvas_size, mag_ratio=args.mag_ratio, backend=args.backend, output_policy=args.output_policy,
+                   cache=args.cache, cache_size=args.cache_size, cache_params=detection_params())
+        sys.exit(0)
 
+    # load net
     print('Loading weights from checkpoint (' + args.trained_model + ')')
-    if args.cuda:
-        net.load_state_dict(copyStateDict(torch.load(args.trained_model)))
-    else:
-        net.load_state_dict(copyStateDict(torch.load(args.trained_model, map_location='cpu')))
-
-    if args.cuda:
-        net = net.cuda()
-        net = torch.nn.DataParallel(net)
-        cudnn.benchmark = False
-
-    net.eval()
+    net = load_model(args.trained_model, args.cuda, args.backend)
 
     # LinkRefiner
     refine_net = None
     if args.refine:
-        from refinenet import RefineNet
-        refine_net = RefineNet()
         print('Loading weights of refiner from checkpoint (' + args.refiner_model + ')')
-        if args.cuda:
-            refine_net.load_state_dict(copyStateDict(torch.load(args.refiner_model)))
-            refine_net = refine_net.cuda()
-            refine_net = torch.nn.DataParallel(refine_net)
-        else:
-            refine_net.load_state_dict(copyStateDict(torch.load(args.refiner_model, map_location='cpu')))
-
-        refine_net.eval()
+        refine_net = load_refiner(args.refiner_model, args.cuda, args.backend)
         args.poly = True
 
+    if args.backend == 'torch' and (args.optimize or args.compile or args.warmup):
+        from optimize import optimize_for_inference, canvas_buckets
+        net, refine_net = optimize_for_inference(net, refine_net, args.cuda, compile=args.compile, cache_dir=args.compile_cache,
+                                                 warmup_shapes=canvas_buckets(args.canvas_size) if args.warmup else None,
+                                                 batch_size=args.batch_size)
+
+    render = args.output_policy == 'debug'
+    metrics.configure(trace_file=args.trace_file)
     t = time.time()
 
-    # load data
-    for k, image_path in enumerate(image_list):
-        print("Test image {:d}/{:d}: {:s}".format(k+1, len(image_list), image_path), end='\r')
-        image = imgproc.loadImage(image_path)
+    cache = None
+    if args.cache:
+        import det_cache
+        cache = det_cache.DetectionCache(args.cache, args.cache_size)
+        cache_model = det_cache.model_id(args.trained_model, args.refiner_model if args.refine else None, args.backend)
+        cache_params = detection_params()
 
-        bboxes, polys, score_text = test_net(net, image, args.text_threshold, args.link_threshold, args.low_text, args.cuda, args.poly, refine_net)
+    # load data
+    for k in range(0, len(image_list), args.batch_size):
+        batch_paths = image_list[k:k + args.batch_size]
+        # one trace line per document, or per stacked batch
+        with metrics.trace(batch_paths[0] if len(batch_paths) == 1 else batch_paths):
+            print("Test image {:d}/{:d}: {:s}".format(k+len(batch_paths), len(image_list), batch_paths[-1]), end='\r')
+
+            # documents seen before skip decode and detection
+            keys = [None] * len(batch_paths)
+            cached = [None] * len(batch_paths)
+            if cache is not None:
+                for i, image_path in enumerate(batch_paths):
+                    with open(image_path, 'rb') as f:
+                        keys[i] = det_cache.cache_key(f.read(), cache_model, cache_params)
+                    cached[i] = cache.get(keys[i])
+            todo = [i for i in range(len(batch_paths)) if cached[i] is None]
+
+            decoded = [imgproc.loadImageReduced(batch_paths[i], decode_size()) for i in todo]
+            images = [image for image, scale in decoded]
+            results = dict(zip(todo, detect_batch(net, refine_net, images, render))) if images else {}
+
+            for i, image_path in enumerate(batch_paths):
+                if cached[i] is not None:
+                    (bboxes, polys), score_text, image, scale = cached[i], None, None, 1
+                else:
+                    (image, scale), (bboxes, polys, score_text) = decoded[todo.index(i)], results[i]
+                if scale != 1:
+                    # back to original image pixels; the debug annotation needs the full image too
+                    bboxes = [box / scale for box in bboxes]
+                    polys = [poly / scale for poly in polys]
+                    image = None
+                if keys[i] is not None and cached[i] is None:
+                    cache.put(keys[i], bboxes, polys)
+                if image is None and args.output_policy == 'debug':
+                    image = imgproc.loadImage(image_path)
+
+                # save coordinates, plus annotated image and score heatmap in debug mode
+                count_page(polys)
+                with metrics.timed('save'):
+                    file_utils.saveOutput(image_path, image, polys, score_text, result_folder, args.output_policy)
 
-        # save score text
-        filename, file_ext = os.path.splitext(os.path.basename(image_path))
-        mask_file = result_folder + "/res_" + filename + '_mask.jpg'
-        cv2.imwrite(mask_file, score_text)
+    print("elapsed time : {}s".format(time.time() - t))
 
-        file_utils.saveResult(image_path, image[:,:,::-1], polys, dirname=result_folder)
+    if cache is not None:
+        print("detection cache : {}".format(json.dumps(cache.stats())))
 
-    print("elapsed time : {}s".format(time.time() - t))
+    if args.metrics_file:
+        metrics.write_prometheus(args.metrics_file)
@@ -0,0 +1,110 @@
+import os
+import json
+import time
+import itertools
+import multiprocessing
+
+import numpy as np
+
+import craft_utils
+from score_store import ScoreStore
+
+# per-process state, filled by _init_worker
+_worker = {}
+
+def detect(store, name, text_threshold, link_threshold, low_text, poly=False):
+    # the post-processing half of craft_module.postprocess, on stored maps
+    score_text, score_link, ratio_w, ratio_h = store.load(name)
+    boxes, polys = craft_utils.getDetBoxes(score_text, score_link, text_threshold, link_threshold, low_text, poly)
+    return craft_utils.adjustResultCoordinates(boxes, ratio_w, ratio_h)
+
+def _init_worker(folder, reference, iou_threshold):
+    _worker['store'] = ScoreStore(folder)
+    _worker['reference'] = reference
+    _worker['iou_threshold'] = iou_threshold
+
+def _evaluate(setting):
+    text_threshold, link_threshold, low_text = setting
+    store = _worker['store']
+    n_ref = n_test = n_match = 0
+    for name, ref_boxes in _worker['reference'].items():
+        boxes = detect(store, name, text_threshold, link_threshold, low_text)
+        n_ref += len(ref_boxes)
+        n_test += len(boxes)
+        n_match += craft_utils.matchBoxes(ref_boxes, boxes, _worker['iou_threshold'])
+    recall = n_match / n_ref if n_ref else 1.0
+    precision = n_match / n_test if n_test else 1.0
+    return {
+        'text_threshold': text_threshold,
+        'link_threshold': link_threshold,
+        'low_text': low_text,
+        'boxes': n_test,
+        'boxes_per_image': n_test / max(len(_worker['reference']), 1),
+        'matched': n_match,
+        'recall': recall,
+        'precision': precision,
+        'f1': 2 * recall * precision / (recall + precision) if recall + precision else 0.0,
+    }
+
+def load_reference_boxes(result_folder, names):
+    # res_<name>.txt files (e.g. a reviewed test.py run) as boxes in original image pixels
+    reference = {}
+    for name in names:
+        res_file = os.path.join(result_folder, 'res_' + os.path.splitext(os.path.basename(name))[0] + '.txt')
+        with open(res_file, 'r') as f:
+            coords = [np.array([float(v) for v in line.strip().split(',')], dtype=np.float32).reshape(-1, 2) for line in f if line.strip()]
+        reference[name] = coords
+    return reference
+
+def sweep(folder, text_thresholds, link_thresholds, low_texts, reference=None, reference_setting=(0.7, 0.4, 0.4), workers=4,
+          iou_threshold=0.5):
+    """ post-process every stored image for each point of the threshold grid
+    Args:
+        folder (str): ScoreStore built by score_store.py
+        reference (dict): name -> boxes to agree with; by default the detections at reference_setting
+    Return:
+        list of per-setting dicts (box counts, matched, recall, precision, f1), best f1 first
+    """
+    store = ScoreStore(folder)
+    if reference is None:
+        reference = {name: detect(store, name, *reference_setting) for name in store.names()}
+    grid = [s for s in itertools.product(text_thresholds, link_thresholds, low_texts) if s[2] <= s[0]]
+    with multiprocessing.Pool(workers, _init_worker, (folder, reference, iou_threshold)) as pool:
+        results = pool.map(_evaluate, grid, chunksize=max(1, len(grid) // (workers * 4)))
+    return sorted(results, key=lambda r: -r['f1'])
+
+def _grid(spec):
+    # "0.5:0.9:0.05" -> 0.5, 0.55, ... 0.9 ; "0.4,0.5" -> 0.4, 0.5
+    if ':' in spec:
+        start, stop, step = [float(v) for v in spec.split(':')]
+        return [round(v, 6) for v in np.arange(start, stop + step / 2, step)]
+    return [float(v) for v in spec.split(',')]
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Threshold sweep over stored CRAFT score maps')
+    parser.add_argument('--store', required=True, type=str, help='folder written by score_store.py')
+    parser.add_argument('--text_threshold', default='0.5:0.9:0.05', type=str, help='grid as start:stop:step or a comma separated list')
+    parser.add_argument('--link_threshold', default='0.2:0.6:0.05', type=str, help='grid as start:stop:step or a comma separated list')
+    parser.add_argument('--low_text', default='0.3:0.5:0.05', type=str, help='grid as start:stop:step or a comma separated list')
+    parser.add_argument('--reference', default='0.7,0.4,0.4', type=str, help='text_threshold,link_threshold,low_text the grid is compared to')
+    parser.add_argument('--gt_folder', default=None, type=str, help='compare against res_<name>.txt files in this folder instead')
+    parser.add_argument('--iou_threshold', default=0.5, type=float, help='IoU for two boxes to count as the same detection')
+    parser.add_argument('--workers', default=4, type=int, help='worker processes')
+    parser.add_argument('--top', default=10, type=int, help='number of settings printed')
+    parser.add_argument('--output', default=None, type=str, help='write the full report as JSON to this file')
+    args = parser.parse_args()
+
+    reference = load_reference_boxes(args.gt_folder, ScoreStore(args.store).names()) if args.gt_folder else None
+    t = time.time()
+    results = sweep(args.store, _grid(args.text_threshold), _grid(args.link_threshold), _grid(args.low_text), reference,
+                    tuple(float(v) for v in args.reference.split(',')), args.workers, args.iou_threshold)
+    print("{:d} settings in {:.1f}s".format(len(results), time.time() - t))
+    print("{:>6s}{:>6s}{:>6s}{:>8s}{:>8s}{:>8s}{:>8s}".format('text', 'link', 'low', 'boxes', 'recall', 'prec', 'f1'))
+    for r in results[:args.top]:
+        print("{:>6.2f}{:>6.2f}{:>6.2f}{:>8d}{:>8.3f}{:>8.3f}{:>8.3f}".format(
+            r['text_threshold'], r['link_threshold'], r['low_text'], r['boxes'], r['recall'], r['precision'], r['f1']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'store': args.store, 'reference': args.gt_folder or args.reference, 'results': results}, f, indent=4)
+        print("Saved " + args.output)
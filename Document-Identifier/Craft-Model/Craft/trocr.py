@@ -4,36 +4,103 @@ import os
 import re
 import time
 import torch
+import metrics
+
+from rec_cache import crop_hash, TEMPLATE_TOLERANCE
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-printed_processor = TrOCRProcessor.from_pretrained('microsoft/trocr-base-printed')
-printed_model = VisionEncoderDecoderModel.from_pretrained('microsoft/trocr-base-printed').to(device)
+MODEL_ID = 'microsoft/trocr-base-printed'
+printed_processor = TrOCRProcessor.from_pretrained(MODEL_ID)
+printed_model = VisionEncoderDecoderModel.from_pretrained(MODEL_ID).to(device)
 
 def ocr_printed_image(src_img):
     pixel_values = printed_processor(images=src_img, return_tensors="pt").pixel_values.to(device)
     generated_ids = printed_model.generate(pixel_values)
     return printed_processor.batch_decode(generated_ids, skip_special_tokens=True)[0]
 
-result_dir = "result"
-segmented_images = [f for f in os.listdir(result_dir) if re.match(r'segment_\d+\.png', f)]
-segmented_images.sort(key=lambda x: int(re.search(r'\d+', x).group()))
-
-total_time = 0
-
-for img_file in segmented_images:
-    image_path = os.path.join(result_dir, img_file)
-    image = Image.open(image_path)
-    
-    start_time = time.time()
-    ocr_output = ocr_printed_image(image)
-    end_time = time.time()
-    
-    elapsed_time = end_time - start_time
-    total_time += elapsed_time
-    
-    print(f"OCR Output for {img_file}: {ocr_output}")
-    # print(f"Time taken for {img_file}: {elapsed_time:.2f} seconds")
-
-average_time = total_time / len(segmented_images)
-print(f"Average time taken per image: {average_time:.2f} seconds")
+def _aspect_ratio(img):
+    w, h = img.size if isinstance(img, Image.Image) else (img.shape[1], img.shape[0])
+    return w / max(h, 1)
+
+def ocr_printed_images(images, max_batch_size=16, cache=None):
+    # crops of similar aspect ratio carry similar amounts of text, so batching them
+    # keeps generate from padding short words up to the longest line in the batch
+    texts = [None] * len(images)
+    if cache is not None:
+        # printed template text ("INCOME TAX DEPARTMENT", "DOB", ...) is recognized once; a crop
+        # repeated within this call is decoded once too
+        keys = [crop_hash(img, MODEL_ID) for img in images]
+        first = {}
+        for i, key in enumerate(keys):
+            if key not in first:
+                first[key] = i
+                texts[i] = cache.get(key)
+        todo = [i for i in first.values() if texts[i] is None]
+        found, batch_times = ocr_printed_images([images[i] for i in todo], max_batch_size)
+        for i, text in zip(todo, found):
+            texts[i] = text
+            cache.put(keys[i], text)
+        return [texts[first[key]] for key in keys], batch_times
+
+    order = sorted(range(len(images)), key=lambda i: _aspect_ratio(images[i]))
+    batch_times = []
+    for b in range(0, len(order), max_batch_size):
+        idx = order[b:b + max_batch_size]
+        start_time = time.perf_counter()
+        with metrics.timed('recognize'):
+            pixel_values = printed_processor(images=[images[i] for i in idx], return_tensors="pt").pixel_values.to(device)
+            generated_ids = printed_model.generate(pixel_values)
+            for i, text in zip(idx, printed_processor.batch_decode(generated_ids, skip_special_tokens=True)):
+                texts[i] = text
+        metrics.inc('crops_recognized', len(idx))
+        batch_times.append((len(idx), time.perf_counter() - start_time))
+    return texts, batch_times
+
+def ocr_segments(segments, max_batch_size=16, cache=None):
+    # segments: [(crop, box)] as returned by craft_module.detect_segments; cache: rec_cache.RecognitionCache
+    texts, batch_times = ocr_printed_images([crop for crop, box in segments], max_batch_size, cache)
+    return [(text, box) for text, (crop, box) in zip(texts, segments)]
+
+def load_segments(result_dir):
+    segmented_images = [f for f in os.listdir(result_dir) if re.match(r'segment_\d+\.png', f)]
+    segmented_images.sort(key=lambda x: int(re.search(r'\d+', x).group()))
+    return [(Image.open(os.path.join(result_dir, f)), f) for f in segmented_images]
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='TrOCR on CRAFT segments')
+    parser.add_argument('--image_path', default=None, type=str, help='run detection in memory on this image instead of reading result_dir')
+    parser.add_argument('--result_dir', default='result', type=str, help='folder of segment_<i>.png files')
+    parser.add_argument('--trained_model', default='weights/craft_mlt_25k.pth', type=str, help='pretrained model')
+    parser.add_argument('--batch_size', default=16, type=int, help='maximum number of crops per generate call')
+    parser.add_argument('--save_segments', default=None, type=str, help='also write the crops to this folder')
+    parser.add_argument('--rec_cache', default=None, type=str, help='recognition cache file kept across runs, e.g. weights/recognitions.jsonl')
+    parser.add_argument('--rec_cache_tolerance', default=TEMPLATE_TOLERANCE, type=float,
+                        help='share of hash bits a rescanned template crop may differ by (0: exact matches only)')
+    args = parser.parse_args()
+
+    cache = None
+    if args.rec_cache:
+        from rec_cache import RecognitionCache
+        cache = RecognitionCache(args.rec_cache, tolerance=args.rec_cache_tolerance)
+
+    if args.image_path:
+        import imgproc
+        from craft_module import detect_segments
+        image = imgproc.loadImage(args.image_path)
+        segments = detect_segments(image, args.trained_model, torch.cuda.is_available(), output_folder=args.save_segments)
+    else:
+        segments = load_segments(args.result_dir)
+
+    texts, batch_times = ocr_printed_images([image for image, box in segments], args.batch_size, cache)
+
+    for i, ocr_output in enumerate(texts):
+        print(f"OCR Output for segment {i}: {ocr_output}")
+
+    for b, (size, elapsed_time) in enumerate(batch_times):
+        print(f"Batch {b}: {size} images in {elapsed_time:.2f} seconds ({elapsed_time / size:.2f} per image)")
+
+    if cache is not None:
+        cache.close()
+        print("Recognition cache: {entries} entries, {hits} hits, {misses} misses ({hit_rate:.0%})".format(**cache.stats()))
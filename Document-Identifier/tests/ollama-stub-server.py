@@ -0,0 +1,131 @@
+import json
+import time
+import random
+import argparse
+import threading
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Stand-in for the Ollama chat API, for exercising Craft/llm_extract.py without a model:
+#   python ollama-stub-server.py --port 11435 --latency 0.5 --fail_rate 0.1
+#   python ../Craft-Model/Craft/llm_extract.py --host http://127.0.0.1:11435 --input texts.txt --concurrency 8
+# Replies with the keys of the requested schema set to null; --fail_rate answers 503 at random.
+# Streamed replies arrive --chunk characters every --token_delay seconds, followed by --chatty
+# trailing text; a client that hangs up before the end is counted as an early close.
+# Requests whose format is an array schema (packed documents) get one item per id; --pack_fail_rate
+# drops the last item of a share of them.
+
+parser = argparse.ArgumentParser(description='Ollama chat API stand-in')
+parser.add_argument('--port', default=11435, type=int)
+parser.add_argument('--latency', default=0.5, type=float, help='seconds per reply')
+parser.add_argument('--fail_rate', default=0.0, type=float, help='share of requests answered with 503')
+parser.add_argument('--chunk', default=4, type=int, help='characters per streamed chunk')
+parser.add_argument('--token_delay', default=0.0, type=float, help='seconds between streamed chunks')
+parser.add_argument('--chatty', default=0, type=int, help='characters of text streamed after the JSON object')
+parser.add_argument('--pack_fail_rate', default=0.0, type=float, help='share of packed replies missing a document')
+args = parser.parse_args()
+
+state = {'in_flight': 0, 'peak': 0, 'requests': 0, 'failed': 0, 'closed_early': 0, 'packed': 0}
+lock = threading.Lock()
+
+def reply_content(messages, format=None):
+    # echo the schema keys found in the system prompt, or an empty object
+    if isinstance(format, dict) and format.get('type') == 'array':
+        item = format['items']
+        keys = [key for key in item['properties'] if key != 'id']
+        items = [dict({'id': doc_id}, **{key: None for key in keys}) for doc_id in item['properties']['id']['enum']]
+        with lock:
+            state['packed'] += 1
+        if random.random() < args.pack_fail_rate:
+            items = items[:-1]
+        return json.dumps(items)
+    for message in messages:
+        if message.get('role') == 'system' and '{' in message.get('content', ''):
+            content = message['content']
+            try:
+                schema = json.loads(content[content.index('{'):content.rindex('}') + 1])
+                return json.dumps({key: None for key in schema})
+            except ValueError:
+                pass
+    return '{}'
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'     # keep-alive, so client connection pooling is visible
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_chunk(self, data):
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def stream(self, request, content):
+        # one NDJSON line per chunk of content, chunked transfer encoding
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        content += ' Let me know if you need anything else.' * (args.chatty // 38 + 1) if args.chatty else ''
+        pieces = [content[i:i + args.chunk] for i in range(0, len(content), args.chunk)] + ['']
+        try:
+            for i, piece in enumerate(pieces):
+                done = i == len(pieces) - 1
+                body = {'model': request.get('model'), 'created_at': datetime.now(timezone.utc).isoformat(),
+                        'message': {'role': 'assistant', 'content': piece}, 'done': done}
+                if done:
+                    body.update(done_reason='stop', total_duration=int(args.latency * 1e9))
+                self.send_chunk((json.dumps(body) + '\n').encode())
+                time.sleep(args.token_delay)
+            self.send_chunk(b'')
+        except (BrokenPipeError, ConnectionResetError):
+            with lock:
+                state['closed_early'] += 1
+            self.close_connection = True
+
+    def do_GET(self):
+        if self.path == '/api/version':
+            self.send_json(200, {'version': 'stub'})
+        elif self.path == '/api/tags':
+            self.send_json(200, {'models': []})
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if self.path != '/api/chat':
+            self.send_json(404, {'error': 'not found'})
+            return
+        with lock:
+            state['requests'] += 1
+            state['in_flight'] += 1
+            state['peak'] = max(state['peak'], state['in_flight'])
+        try:
+            time.sleep(args.latency)
+            if random.random() < args.fail_rate:
+                with lock:
+                    state['failed'] += 1
+                self.send_json(503, {'error': 'server busy'})
+                return
+            message = {'role': 'assistant', 'content': reply_content(request.get('messages', []), request.get('format'))}
+            body = {'model': request.get('model'), 'created_at': datetime.now(timezone.utc).isoformat(), 'message': message,
+                    'done': True, 'done_reason': 'stop', 'total_duration': int(args.latency * 1e9)}
+            if request.get('stream', True):
+                self.stream(request, message['content'])
+            else:
+                self.send_json(200, body)
+        finally:
+            with lock:
+                state['in_flight'] -= 1
+
+    def log_message(self, format, *log_args):
+        print("{} in flight (peak {}), {} requests ({} packed), {} failed, {} closed early: {}".format(
+            state['in_flight'], state['peak'], state['requests'], state['packed'], state['failed'], state['closed_early'],
+            format % log_args))
+
+print(f"Ollama stub listening on http://127.0.0.1:{args.port}")
+ThreadingHTTPServer(('127.0.0.1', args.port), Handler).serve_forever()
@@ -0,0 +1,64 @@
+import io
+import os
+import sys
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont, ImageFilter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Craft-Model', 'Craft'))
+from rec_cache import crop_hash, RecognitionCache
+
+# Checks Craft/rec_cache.py on rendered crops, no model needed:
+#   python rec-cache-rescan-check.py
+# A template crop rescanned at +-5% width, with extra margin, fresh noise and JPEG must hit the
+# cached entry; personal data differing in one digit must never hit.
+
+rng = np.random.default_rng(0)
+font = ImageFont.load_default(size=28)
+
+def crop(text, pad=3):
+    l, t, r, b = font.getbbox(text)
+    img = Image.new('L', (r - l + 2 * pad, b - t + 2 * pad), 255)
+    ImageDraw.Draw(img).text((pad - l, pad - t), text, fill=0, font=font)
+    return img
+
+def rescan(img, width_scale=1.0, margin=0):
+    w, h = img.size
+    img = img.resize((round(w * width_scale), h), Image.BILINEAR)
+    if margin:
+        canvas = Image.new('L', (img.size[0] + margin, h), 255)
+        canvas.paste(img, (margin // 2, 0))
+        img = canvas
+    pixels = np.asarray(img.filter(ImageFilter.GaussianBlur(0.6)), dtype=np.float32) * 0.8 + 30
+    pixels += rng.normal(0, 12, pixels.shape)
+    buf = io.BytesIO()
+    Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).convert('RGB').save(buf, 'JPEG', quality=60)
+    return Image.open(buf)
+
+templates = ['GOVERNMENT OF INDIA', 'INCOME TAX DEPARTMENT', 'Permanent Account Number', 'DOB', 'Signature', "Father's Name"]
+personal = ['1234 5678 9012', '12/05/1998', 'RAVI KUMAR']
+variants = {'1234 5678 9012': ['1234 3678 9012', '1254 5678 9012', '1234 5678 9013'],
+            '12/05/1998': ['12/05/1990', '13/05/1998'], 'RAVI KUMAR': ['RAVI KUMAN', 'RAMA KUMAR']}
+
+cache = RecognitionCache()
+for text in templates + personal:
+    cache.put(crop_hash(crop(text)), text)
+
+failed = 0
+for text in templates:
+    for width_scale in (0.95, 1.0, 1.05):
+        for margin in (0, 6):
+            found = cache.get(crop_hash(rescan(crop(text), width_scale, margin)))
+            if found != text:
+                failed += 1
+                print(f"miss: {text!r} at width x{width_scale}, margin {margin}: {found!r}")
+for text, others in variants.items():
+    for other in others + [text]:
+        found = cache.get(crop_hash(rescan(crop(other))))
+        if found is not None:
+            failed += 1
+            print(f"personal data returned: {other!r} -> {found!r}")
+
+print("{hits} hits, {misses} misses".format(**cache.stats()))
+print("FAILED: {:d} checks".format(failed) if failed else "OK")
+sys.exit(1 if failed else 0)